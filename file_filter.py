@@ -2,8 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import errno
+import email.utils
+import mmap
+import select
+import sqlite3
+import tempfile
+import struct
 import shutil
+import tarfile
+import zipfile
 import argparse
+import collections
 import hashlib
 import pandas as pd
 import re
@@ -15,7 +26,10 @@ from PIL import Image
 import io
 import base64
 import time
+import random
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
@@ -41,14 +55,88 @@ QWEN_API_KEY = "sk-2a293b2cc0cc4b679c6aea6ce82ae7fe"
 # AI请求健壮性配置（可由命令行参数覆盖）
 AI_REQUEST_TIMEOUT_S = 40
 AI_REQUEST_MAX_RETRIES = 2
-AI_REQUEST_QPS = 1.0  # 每秒请求数上限
-_AI_LAST_CALL_TS = 0.0
-_AI_RATE_LOCK = threading.Lock()
+AI_REQUEST_QPS = 1.0  # 初始每秒请求数（自适应调整；<= 0 表示不限速）
+AI_MIN_QPS = 0.1  # 自适应限速的下限
+AI_MAX_QPS = 5.0  # 自适应限速的上限
+AI_MAX_CONCURRENCY = 4  # 同时进行的AI请求数上限（服务模式等多线程场景）
+AI_QPS_INCREASE_STEP = 0.05  # 每次健康请求后速率的加性增量
+AI_LATENCY_TARGET_S = 15  # 延迟超过该值时不再上调速率
+AI_RETRY_AFTER_MAX_S = 300  # Retry-After 最长遵从时间
+_AI_SESSION_LOCAL = threading.local()
 
 # 支持的图片格式（包含常见别名）
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif', '.webp', '.heic', '.heif'}
 RAW_EXTENSIONS = {'.raw', '.cr2', '.nef', '.arw', '.dng', '.orf', '.rw2', '.pef', '.srw', '.raf', '.x3f'}
 
+class _OperationCancelled(Exception):
+    """处理过程中检测到用户取消（在复制/哈希分块、重试等待、AI 请求等位置抛出）。"""
+
+def _cancel_requested(is_cancelled):
+    return bool(is_cancelled and callable(is_cancelled) and is_cancelled())
+
+def _raise_if_cancelled(is_cancelled):
+    if _cancel_requested(is_cancelled):
+        raise _OperationCancelled()
+
+def _sleep_cancellable(seconds, is_cancelled=None, poll_s=0.1):
+    """可被取消打断的 sleep：每 poll_s 秒检查一次取消标志。"""
+    if not is_cancelled:
+        time.sleep(seconds)
+        return
+    deadline = time.monotonic() + seconds
+    while True:
+        _raise_if_cancelled(is_cancelled)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(poll_s, remaining))
+
+def _run_cancellable(func, is_cancelled=None, on_abandon=None, poll_s=0.1):
+    """在后台线程执行无法中断的阻塞调用（RAW 解码、HTTP 请求），等待期间轮询取消标志。
+
+    取消时立即抛出 _OperationCancelled，后台调用继续运行至结束，
+    其返回值随后交给 on_abandon 清理（删除临时文件、关闭响应等）。
+    """
+    if not is_cancelled:
+        return func()
+    state = {}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def _runner():
+        try:
+            state['result'] = func()
+        except BaseException as e:  # noqa: BLE001
+            state['error'] = e
+        with lock:
+            done.set()
+            abandoned = state.get('abandoned')
+        if abandoned and on_abandon and 'result' in state:
+            try:
+                on_abandon(state['result'])
+            except Exception:
+                pass
+
+    threading.Thread(target=_runner, daemon=True).start()
+    while not done.wait(poll_s):
+        if _cancel_requested(is_cancelled):
+            with lock:
+                if not done.is_set():
+                    state['abandoned'] = True
+                    raise _OperationCancelled()
+            break
+    if 'error' in state:
+        raise state['error']
+    return state['result']
+
+def _remove_quietly(path):
+    """删除临时或未完成的文件，忽略不存在等错误。"""
+    try:
+        if path and os.path.exists(path):
+            os.remove(path)
+    except Exception:
+        pass
+
 def is_raw_format(file_path):
     """检查是否为RAW格式文件"""
     ext = os.path.splitext(file_path)[1].lower()
@@ -133,23 +221,210 @@ def convert_to_jpg(image_path, quality=85, max_size=(1024, 768)):
         print(f"转换图片失败 {image_path}: {e}")
         return None
 
-def analyze_image_with_qwen(image_path):
-    """使用通义千问视觉模型分析图片内容（多模态 generation 接口）。"""
+def _get_ai_session():
+    """返回当前线程复用的 requests.Session，保持与 API 端点的连接池（Keep-Alive）。"""
+    session = getattr(_AI_SESSION_LOCAL, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _AI_SESSION_LOCAL.session = session
+    return session
+
+def _post_cancellable(url, is_cancelled=None, **kwargs):
+    """发送 POST 请求；请求进行中被取消时立即返回（抛出 _OperationCancelled），不再等待响应或超时。"""
+    session = _get_ai_session()
+
+    def _abandon(response):
+        response.close()
+        session.close()
+
+    try:
+        return _run_cancellable(lambda: session.post(url, **kwargs), is_cancelled, on_abandon=_abandon)
+    except _OperationCancelled:
+        # 被放弃的请求仍占用该会话，后续请求改用新会话
+        _AI_SESSION_LOCAL.session = None
+        raise
+
+class _AdaptiveRateController:
+    """
+    AI 请求的自适应（AIMD）速率与并发控制
+
+    请求成功且延迟、错误率正常时，速率按 AI_QPS_INCREASE_STEP 加性上调，并发上限每轮约加 1——
+    但只在该限制确实起作用时上调（请求曾等待速率间隔/并发名额），不会替从未达到的负载“预支”额度；
+    遇到 408/429/5xx、超时或连接错误时两者减半（每个往返周期至多一次，避免同批失败重复惩罚）。
+    响应带 Retry-After 时，所有线程暂停到指定时间；请求间隔带 ±10% 抖动，避免多个进程同步撞车。
+    """
+
+    def __init__(self, initial_qps, min_qps, max_qps, max_concurrency):
+        self.min_qps = min_qps
+        self.max_qps = max(max_qps, min_qps)
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate = min(max(initial_qps, self.min_qps), self.max_qps)
+        self.limit = 1.0
+        self.in_flight = 0
+        self.requests = 0
+        self.congested = 0
+        self._error_ewma = 0.0
+        self._next_slot = 0.0
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._first_started = None
+        self._last_finished = None
+        self._cond = threading.Condition()
+
+    def acquire(self, is_cancelled=None):
+        """等待到并发与速率都允许时占用一个请求名额。
+
+        返回 (rate_limited, concurrency_limited)：本次是否曾因速率间隔或并发上限而等待，需原样传给 release。
+        """
+        rate_limited = concurrency_limited = False
+        with self._cond:
+            while True:
+                _raise_if_cancelled(is_cancelled)
+                now = time.monotonic()
+                wait = max(self._next_slot, self._blocked_until) - now
+                if self.in_flight < int(self.limit) and wait <= 0:
+                    self.in_flight += 1
+                    self._next_slot = max(now, self._next_slot) + random.uniform(0.9, 1.1) / self.rate
+                    if self._first_started is None:
+                        self._first_started = now
+                    return rate_limited, concurrency_limited
+                if self.in_flight >= int(self.limit):
+                    concurrency_limited = True
+                if self._next_slot > now:
+                    rate_limited = True
+                # 定期醒来检查取消标志
+                self._cond.wait(timeout=min(0.1, wait) if wait > 0 else 0.1)
+
+    def release(self, outcome, latency_s, retry_after_s=None, limited=(False, False)):
+        """归还名额并根据结果调整速率；outcome 为 HTTP 状态码、'timeout'、'error' 或 'cancelled'，limited 为 acquire 的返回值。"""
+        rate_limited, concurrency_limited = limited
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+            if outcome == 'cancelled':
+                return
+            now = time.monotonic()
+            self.requests += 1
+            self._last_finished = now
+            congested = outcome in ('timeout', 'error', 408, 429) or (isinstance(outcome, int) and 500 <= outcome < 600)
+            self._error_ewma = 0.8 * self._error_ewma + (0.2 if congested else 0.0)
+            if congested:
+                self.congested += 1
+                if now - self._last_decrease > max(latency_s, 1.0 / self.rate):
+                    self.rate = max(self.min_qps, self.rate * 0.5)
+                    self.limit = max(1.0, self.limit * 0.5)
+                    self._last_decrease = now
+                if retry_after_s:
+                    self._blocked_until = max(self._blocked_until, now + retry_after_s)
+            elif isinstance(outcome, int) and 200 <= outcome < 300 and latency_s <= AI_LATENCY_TARGET_S and self._error_ewma < 0.1:
+                if rate_limited:
+                    self.rate = min(self.max_qps, self.rate + AI_QPS_INCREASE_STEP)
+                if concurrency_limited:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+
+    def measured_qps(self):
+        """本进程从第一次请求开始到最近一次请求结束的实际平均请求速率；尚无完成的请求时返回 0。"""
+        with self._cond:
+            if self._first_started is None or self._last_finished is None or self._last_finished <= self._first_started:
+                return 0.0
+            return self.requests / (self._last_finished - self._first_started)
+
+    def report(self):
+        """打印当前允许的速率与并发上限，以及实际测得的请求速率。"""
+        measured = self.measured_qps()
+        with self._cond:
+            print(f"AI自适应限速: 允许速率 {self.rate:.2f} QPS（实际 {measured:.2f} QPS），并发上限 {int(self.limit)}，"
+                  f"本进程累计请求 {self.requests} 次（限流/错误 {self.congested} 次）")
+
+_AI_CONTROLLER = None
+_AI_CONTROLLER_LOCK = threading.Lock()
+
+def _get_ai_controller():
+    """返回进程内共享的自适应限速器；AI_REQUEST_QPS <= 0 表示不限速，返回 None。"""
+    global _AI_CONTROLLER
+    if AI_REQUEST_QPS <= 0:
+        return None
+    with _AI_CONTROLLER_LOCK:
+        if _AI_CONTROLLER is None:
+            _AI_CONTROLLER = _AdaptiveRateController(AI_REQUEST_QPS, AI_MIN_QPS, AI_MAX_QPS, AI_MAX_CONCURRENCY)
+        return _AI_CONTROLLER
+
+def _report_ai_rate(use_ai_naming):
+    """AI 命名运行结束时报告限速器收敛结果。"""
+    controller = _AI_CONTROLLER
+    if use_ai_naming and controller is not None and controller.requests:
+        controller.report()
+
+def _parse_retry_after(value):
+    """解析 Retry-After 头（秒数或 HTTP 日期），返回等待秒数（不超过 AI_RETRY_AFTER_MAX_S）或 None。"""
+    if not value:
+        return None
     try:
-        # 转换图片为JPG格式（包含压缩）
-        jpg_path = convert_to_jpg(image_path, quality=80, max_size=(1024, 768))
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            seconds = retry_at.timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), AI_RETRY_AFTER_MAX_S)
+
+def _send_ai_request(headers, payload, is_cancelled=None):
+    """经自适应限速器发送一次请求，返回 (response, error)，并把结果与延迟反馈给限速器。"""
+    controller = _get_ai_controller()
+    limited = (False, False)
+    if controller is not None:
+        limited = controller.acquire(is_cancelled)
+    started = time.monotonic()
+    outcome = 'cancelled'
+    retry_after_s = None
+    try:
+        response = _post_cancellable(QWEN_API_URL, is_cancelled, headers=headers, json=payload, timeout=AI_REQUEST_TIMEOUT_S)
+        outcome = response.status_code
+        retry_after_s = _parse_retry_after(response.headers.get('Retry-After'))
+        return response, None
+    except _OperationCancelled:
+        raise
+    except requests.Timeout as e:
+        outcome = 'timeout'
+        return None, e
+    except Exception as e:  # noqa: BLE001
+        outcome = 'error'
+        return None, e
+    finally:
+        if controller is not None:
+            controller.release(outcome, time.monotonic() - started, retry_after_s, limited)
+
+def _retry_delay(backoff, attempt, response=None):
+    """重试等待时间：带抖动的指数退避，且不少于服务端 Retry-After。"""
+    delay = backoff ** attempt * random.uniform(0.5, 1.5)
+    if response is not None:
+        delay = max(delay, _parse_retry_after(response.headers.get('Retry-After')) or 0.0)
+    return delay
+
+def analyze_image_with_qwen(image_path, is_cancelled=None):
+    """使用通义千问视觉模型分析图片内容（多模态 generation 接口）。
+
+    is_cancelled 返回 True 时，图片转换、限速等待、重试退避与进行中的请求都会立即中止并抛出 _OperationCancelled。
+    """
+    try:
+        # 转换图片为JPG格式（包含压缩）；RAW 解码无法中途打断，取消后由后台线程删除其临时文件
+        jpg_path = _run_cancellable(
+            lambda: convert_to_jpg(image_path, quality=80, max_size=(1024, 768)),
+            is_cancelled,
+            on_abandon=_remove_quietly,
+        )
         if not jpg_path:
             return None
 
-        # 读取图片并编码为base64（以 data URL 形式传入 image 字段）
-        with open(jpg_path, 'rb') as f:
-            image_base64 = base64.b64encode(f.read()).decode('utf-8')
+        # 读取图片并编码为base64（以 data URL 形式传入 image 字段），无论成功与否都清理临时文件
+        try:
+            with open(jpg_path, 'rb') as f:
+                image_base64 = base64.b64encode(f.read()).decode('utf-8')
+        finally:
+            _remove_quietly(jpg_path)
         image_data_url = f"data:image/jpeg;base64,{image_base64}"
 
-        # 清理临时文件
-        if os.path.exists(jpg_path):
-            os.remove(jpg_path)
-
         # 准备API请求
         headers = {
             "Authorization": f"Bearer {QWEN_API_KEY}",
@@ -175,23 +450,12 @@ def analyze_image_with_qwen(image_path):
             }
         }
 
-        # 发送API请求（带速率限制与重试）
+        # 发送API请求（自适应限速，带抖动的退避重试）
         backoff = 1.5
         attempt = 0
         while True:
-            # 速率限制：全局串行节流，避免超QPS
-            if AI_REQUEST_QPS > 0:
-                interval = 1.0 / AI_REQUEST_QPS
-                with _AI_RATE_LOCK:
-                    now = time.time()
-                    wait = max(0.0, interval - (now - _AI_LAST_CALL_TS))
-                    if wait > 0:
-                        time.sleep(wait)
-                    # 更新最后调用时间
-                    globals()['_AI_LAST_CALL_TS'] = time.time()
-
-            try:
-                response = requests.post(QWEN_API_URL, headers=headers, json=payload, timeout=AI_REQUEST_TIMEOUT_S)
+            response, req_err = _send_ai_request(headers, payload, is_cancelled)
+            if response is not None:
                 status = response.status_code
                 if status >= 200 and status < 300:
                     break
@@ -203,24 +467,16 @@ def analyze_image_with_qwen(image_path):
                     except Exception:
                         pass
                     return None
-                if status in (408, 429) or 500 <= status < 600:
-                    if attempt < AI_REQUEST_MAX_RETRIES:
-                        sleep_s = backoff ** attempt
-                        time.sleep(sleep_s)
-                        attempt += 1
-                        continue
-                    else:
-                        response.raise_for_status()
-                # 其他状态码，直接抛出
-                response.raise_for_status()
-            except Exception as req_err:
-                if attempt < AI_REQUEST_MAX_RETRIES:
-                    sleep_s = backoff ** attempt
-                    time.sleep(sleep_s)
-                    attempt += 1
-                    continue
-                print(f"AI请求失败且重试耗尽: {req_err}")
-                return None
+                try:
+                    response.raise_for_status()
+                except Exception as http_err:
+                    req_err = http_err
+            if attempt < AI_REQUEST_MAX_RETRIES:
+                _sleep_cancellable(_retry_delay(backoff, attempt, response), is_cancelled)
+                attempt += 1
+                continue
+            print(f"AI请求失败且重试耗尽: {req_err}")
+            return None
 
         result = response.json()
         # 解析多模态 generation 输出，兼容 output.text 和 output.choices[0].message.content[*].text
@@ -252,6 +508,8 @@ def analyze_image_with_qwen(image_path):
         description = re.sub(r'_+', '_', description).strip('_')
         return description
 
+    except _OperationCancelled:
+        raise
     except Exception as e:
         print(f"AI分析图片失败 {image_path}: {e}")
         return None
@@ -264,24 +522,129 @@ def _iter_source_files(source_folder):
                 continue
             yield root, filename
 
-def _compute_sha256(file_path, chunk_size=1024 * 1024):
-    """计算文件的 SHA-256 校验值。"""
+# 大于该阈值的文件使用 mmap 计算哈希，避免逐块读取
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+# 内核复制与 mmap 哈希每段的大小，也是检查取消标志的粒度
+_KERNEL_CHUNK_SIZE = 64 * 1024 * 1024
+
+def _compute_sha256(file_path, chunk_size=1024 * 1024, mmap_threshold=None, is_cancelled=None):
+    """计算文件的 SHA-256 校验值。
+
+    大文件通过 mmap 直接交给 hashlib；其余文件复用同一块预分配缓冲区 readinto，
+    不再为每个分块创建新的 bytes 对象。每个分块之间检查 is_cancelled。
+    """
     sha256 = hashlib.sha256()
+    mmap_threshold = HASH_MMAP_THRESHOLD if mmap_threshold is None else mmap_threshold
     with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0 and size >= mmap_threshold:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        for offset in range(0, size, _KERNEL_CHUNK_SIZE):
+                            _raise_if_cancelled(is_cancelled)
+                            sha256.update(view[offset:offset + _KERNEL_CHUNK_SIZE])
+                return sha256.hexdigest()
+            except (OSError, ValueError):
+                # 部分文件系统不支持 mmap，回退到缓冲区读取
+                f.seek(0)
+                sha256 = hashlib.sha256()
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
         while True:
-            data = f.read(chunk_size)
-            if not data:
+            _raise_if_cancelled(is_cancelled)
+            n = f.readinto(buffer)
+            if not n:
                 break
-            sha256.update(data)
+            sha256.update(view[:n])
     return sha256.hexdigest()
 
-def _copy_with_verify(source_file, target_file, max_retries=2):
+# 复制后端：auto 时按平台依次尝试 copy_file_range → sendfile → shutil
+COPY_BACKEND = 'auto'
+
+def _select_copy_backend():
+    """返回当前平台可用的内核态复制方式。"""
+    if COPY_BACKEND != 'auto':
+        return COPY_BACKEND
+    if hasattr(os, 'copy_file_range'):
+        return 'copy_file_range'
+    # macOS 的 sendfile 只支持写入 socket，仅在 Linux 上用于文件到文件
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        return 'sendfile'
+    return 'shutil'
+
+# 内核复制失败后的用户态分块复制每块大小（块越大，Python 循环开销越小，取消响应略慢）
+_FALLBACK_CHUNK_SIZE = 8 * 1024 * 1024
+
+def _copy_file_chunked(source_file, target_file, is_cancelled=None, chunk_size=_FALLBACK_CHUNK_SIZE):
+    """用户态分块复制（同 shutil.copy2 语义），每块之间检查取消标志。"""
+    with open(source_file, 'rb') as fsrc, open(target_file, 'wb') as fdst:
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            _raise_if_cancelled(is_cancelled)
+            n = fsrc.readinto(buffer)
+            if not n:
+                break
+            fdst.write(view[:n])
+    shutil.copystat(source_file, target_file)
+
+def _copy_file(source_file, target_file, backend=None, is_cancelled=None):
+    """复制文件内容与元数据（同 shutil.copy2），优先在内核中完成数据搬运。
+
+    copy_file_range 在支持的文件系统上可以直接 reflink 或由 NFS/SMB 服务器端复制；
+    内核态复制不可用（跨文件系统、不支持的设备等）时回退到 shutil.copy2。
+    提供 is_cancelled 时按段检查取消；内核复制失败后的回退也改用可中断的大块分块复制。
+    shutil 后端（macOS/Windows）始终使用 shutil.copy2 以保留平台快速路径（如 APFS 克隆），
+    取消只能在整个文件复制完成后生效。
+    """
+    def _fallback(chunked):
+        if is_cancelled and chunked:
+            _copy_file_chunked(source_file, target_file, is_cancelled)
+        else:
+            _raise_if_cancelled(is_cancelled)
+            shutil.copy2(source_file, target_file)
+            _raise_if_cancelled(is_cancelled)
+
+    backend = backend or _select_copy_backend()
+    if backend == 'shutil':
+        _fallback(chunked=False)
+        return
+    try:
+        with open(source_file, 'rb') as fsrc, open(target_file, 'wb') as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            copied = 0
+            while remaining > 0:
+                _raise_if_cancelled(is_cancelled)
+                count = min(remaining, _KERNEL_CHUNK_SIZE)
+                if backend == 'copy_file_range':
+                    sent = os.copy_file_range(src_fd, dst_fd, count)
+                else:
+                    sent = os.sendfile(dst_fd, src_fd, copied, count)
+                if sent == 0:
+                    if copied == 0:
+                        # 部分伪文件系统报告了大小却读不出数据
+                        raise OSError(errno.EINVAL, "内核复制未传输任何数据")
+                    break
+                copied += sent
+                remaining -= sent
+        shutil.copystat(source_file, target_file)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY):
+            raise
+        _fallback(chunked=True)
+
+def _copy_with_verify(source_file, target_file, max_retries=2, is_cancelled=None):
     """复制文件到目标位置，并进行内容校验；失败将按次数重试。
 
     返回 True 表示复制并校验成功；否则 False。
+    复制或校验过程中被取消时删除未完成的目标文件并抛出 _OperationCancelled。
     """
     try:
-        source_hash = _compute_sha256(source_file)
+        source_hash = _compute_sha256(source_file, is_cancelled=is_cancelled)
+    except _OperationCancelled:
+        raise
     except Exception as e:  # noqa: BLE001
         print(f"计算源文件哈希失败: {source_file} -> {e}")
         return False
@@ -289,34 +652,498 @@ def _copy_with_verify(source_file, target_file, max_retries=2):
     attempt = 0
     while attempt <= max_retries:
         try:
-            shutil.copy2(source_file, target_file)
+            _copy_file(source_file, target_file, is_cancelled=is_cancelled)
             # 快速尺寸检查
             if os.path.getsize(source_file) != os.path.getsize(target_file):
                 raise IOError("文件大小不一致")
             # 严格哈希校验
-            target_hash = _compute_sha256(target_file)
+            target_hash = _compute_sha256(target_file, is_cancelled=is_cancelled)
             if target_hash == source_hash:
                 return True
             raise IOError("哈希不一致")
+        except _OperationCancelled:
+            _remove_quietly(target_file)
+            raise
         except Exception as e:  # noqa: BLE001
             if attempt < max_retries:
                 print(f"复制校验失败 (第{attempt + 1}次): {e}，准备重试…")
-                try:
-                    if os.path.exists(target_file):
-                        os.remove(target_file)
-                except Exception:
-                    pass
+                _remove_quietly(target_file)
                 attempt += 1
                 continue
             else:
                 print(f"复制校验最终失败: {e}")
-                try:
-                    if os.path.exists(target_file):
-                        os.remove(target_file)
-                except Exception:
-                    pass
+                _remove_quietly(target_file)
                 return False
 
+def _copy_to_many_with_verify(source_file, target_files, max_retries=2, chunk_size=1024 * 1024, is_cancelled=None):
+    """将一个源文件一次读取、同时写入多个目标，并逐个校验大小与 SHA-256。
+
+    源文件只读取一遍（同时计算源哈希）；个别目标校验失败时再单独走 _copy_with_verify 重试。
+    返回与 target_files 一一对应的成功标志列表。被取消时删除本次写入的全部目标文件（包括已校验通过的）。
+    """
+    if len(target_files) == 1:
+        return [_copy_with_verify(source_file, target_files[0], max_retries=max_retries, is_cancelled=is_cancelled)]
+
+    sha256 = hashlib.sha256()
+    try:
+        outputs = []
+        try:
+            with open(source_file, 'rb') as fsrc:
+                for target_file in target_files:
+                    outputs.append(open(target_file, 'wb'))
+                buffer = bytearray(chunk_size)
+                view = memoryview(buffer)
+                while True:
+                    _raise_if_cancelled(is_cancelled)
+                    n = fsrc.readinto(buffer)
+                    if not n:
+                        break
+                    sha256.update(view[:n])
+                    for out in outputs:
+                        out.write(view[:n])
+        finally:
+            for out in outputs:
+                out.close()
+        source_hash = sha256.hexdigest()
+        source_size = os.path.getsize(source_file)
+    except _OperationCancelled:
+        for target_file in target_files:
+            _remove_quietly(target_file)
+        raise
+    except Exception as e:  # noqa: BLE001
+        print(f"多目标复制失败，改为逐个复制: {source_file} -> {e}")
+        for target_file in target_files:
+            _remove_quietly(target_file)
+        return [_copy_with_verify(source_file, t, max_retries=max_retries, is_cancelled=is_cancelled) for t in target_files]
+
+    results = []
+    try:
+        for target_file in target_files:
+            try:
+                shutil.copystat(source_file, target_file)
+                if os.path.getsize(target_file) != source_size:
+                    raise IOError("文件大小不一致")
+                if _compute_sha256(target_file, is_cancelled=is_cancelled) != source_hash:
+                    raise IOError("哈希不一致")
+                results.append(True)
+            except _OperationCancelled:
+                raise
+            except Exception as e:  # noqa: BLE001
+                print(f"复制校验失败: {target_file} -> {e}，准备单独重试…")
+                _remove_quietly(target_file)
+                results.append(_copy_with_verify(source_file, target_file, max_retries=max_retries, is_cancelled=is_cancelled))
+    except _OperationCancelled:
+        # 该源文件整体视为未完成：已校验的目标也一并删除，调用方的计数与磁盘保持一致
+        for target_file in target_files:
+            _remove_quietly(target_file)
+        raise
+    return results
+
+# 参考表格超过该大小（字节）时改用磁盘上的 SQLite 标识符索引，内存占用与表格行数无关
+IDENTIFIER_INDEX_THRESHOLD_BYTES = 50 * 1024 * 1024
+# 磁盘索引模糊匹配时，每个 token 最多取出的候选标识符数量
+FUZZY_CANDIDATE_LIMIT = 500
+# 候选查询只使用出现频率最低的若干个 3-gram，避免常见片段（如统一前缀）扫描大量行
+FUZZY_QUERY_GRAMS = 8
+# 索引文件格式版本，变化后已有索引自动重建
+IDENTIFIER_INDEX_FORMAT = 2
+# 标识符索引的保存目录；None 时保存在参考表格旁，该目录不可写则改用系统临时目录下的缓存
+IDENTIFIER_INDEX_DIR = None
+
+def _identifier_grams(key):
+    """模糊匹配候选所用的 3-gram 集合（首尾补空格，短标识符也至少有一个）。"""
+    padded = f" {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _iter_reference_chunks(reference_file, chunksize=100000):
+    """分块读取参考表格第一列，逐块产生小写标识符列表。"""
+    if reference_file.endswith(('.xlsx', '.xls')):
+        # Excel 无法流式读取，但单表行数上限约百万，仍在可控范围内
+        chunks = [pd.read_excel(reference_file, header=0, usecols=[0])]
+    elif reference_file.endswith('.csv'):
+        chunks = pd.read_csv(reference_file, header=0, usecols=[0], chunksize=chunksize)
+    else:
+        raise ValueError("参考文件必须是Excel(.xlsx/.xls)或CSV(.csv)格式")
+
+    for chunk in chunks:
+        if len(chunk.columns) < 1:
+            raise ValueError("参考表格必须至少包含一列：标识符")
+        identifiers = []
+        for value in chunk[chunk.columns[0]]:
+            identifier = str(value).strip()
+            if identifier:
+                identifiers.append(identifier.lower())
+        yield identifiers
+
+class IdentifierIndex:
+    """
+    SQLite 磁盘标识符索引，用于超出内存的大型参考表格
+
+    表 identifiers 保存标识符及其长度；gram_ids 把每个 3-gram 映射为整数编号并记录出现次数，
+    grams 为按 (gram_id, id) 聚簇的倒排索引（WITHOUT ROWID，不重复保存 3-gram 文本，也无需额外索引）。
+    精确查找走 value 索引；模糊匹配用最稀有的几个 3-gram 按长度范围与共享数取出少量候选，
+    再交给 difflib 计算相似度，因此内存占用只与候选数量有关。
+    索引文件记录参考表格的修改时间与大小，表格变化后自动重建。
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._local = threading.local()
+        self._count = int(self._meta('count') or 0)
+
+    @staticmethod
+    def _candidate_files(reference_file):
+        """索引文件的候选位置：IDENTIFIER_INDEX_DIR，或表格旁的 .idx.sqlite 与临时目录缓存。"""
+        abs_path = os.path.abspath(reference_file)
+        digest = hashlib.sha1(abs_path.encode('utf-8')).hexdigest()[:16]
+        cache_name = f"{os.path.basename(abs_path)}.{digest}.idx.sqlite"
+        if IDENTIFIER_INDEX_DIR:
+            return [os.path.join(IDENTIFIER_INDEX_DIR, cache_name)]
+        return [abs_path + '.idx.sqlite', os.path.join(tempfile.gettempdir(), 'photo_filter_index', cache_name)]
+
+    @classmethod
+    def _open_if_current(cls, index_file, version):
+        """打开与参考表格版本一致的已有索引，不存在、已过期或损坏时返回 None。"""
+        if not os.path.exists(index_file):
+            return None
+        try:
+            index = cls(index_file)
+            if index._meta('source_version') == version:
+                return index
+            index.close()
+        except sqlite3.Error:
+            pass
+        print(f"标识符索引已过期或损坏，将重建: {index_file}")
+        return None
+
+    @classmethod
+    def for_reference(cls, reference_file, index_file=None):
+        """返回 reference_file 对应的索引，不存在或已过期时先构建。
+
+        未指定 index_file 时优先使用表格旁的 <表格>.idx.sqlite；表格所在目录不可写（如只读共享）时
+        改用临时目录下按绝对路径哈希命名的缓存文件。所有位置都无法写入时抛出 OSError。
+        """
+        st = os.stat(reference_file)
+        version = f"{IDENTIFIER_INDEX_FORMAT}:{st.st_mtime_ns}:{st.st_size}"
+        candidates = [index_file] if index_file else cls._candidate_files(reference_file)
+        for candidate in candidates:
+            index = cls._open_if_current(candidate, version)
+            if index is not None:
+                return index
+
+        last_error = None
+        for candidate in candidates:
+            directory = os.path.dirname(candidate) or '.'
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                last_error = e
+                continue
+            if not os.access(directory, os.W_OK):
+                last_error = PermissionError(f"目录不可写: {directory}")
+                continue
+            try:
+                cls.build(reference_file, candidate, version)
+                return cls(candidate)
+            except (OSError, sqlite3.Error) as e:
+                last_error = e
+                print(f"无法在此位置构建标识符索引: {candidate} -> {e}")
+        raise OSError(f"没有可写入标识符索引的位置: {last_error}")
+
+    @staticmethod
+    def build(reference_file, index_file, source_version=''):
+        """从参考表格分块构建索引；先写临时文件，完成后原子替换。"""
+        print(f"正在构建标识符索引: {index_file}")
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        try:
+            IdentifierIndex._write_index(reference_file, tmp_file, source_version)
+            os.replace(tmp_file, index_file)
+        except BaseException:
+            _remove_quietly(tmp_file)
+            raise
+
+    @staticmethod
+    def _write_index(reference_file, tmp_file, source_version):
+        conn = sqlite3.connect(tmp_file)
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE identifiers (id INTEGER PRIMARY KEY, value TEXT NOT NULL, len INTEGER NOT NULL)")
+            # 3-gram 在内存中编号（不同 3-gram 的数量有限），倒排条目先写入临时表，
+            # 再排序后一次性写入聚簇表，避免按随机顺序插入 B 树
+            conn.execute("CREATE TEMP TABLE gram_rows (gram_id INTEGER NOT NULL, id INTEGER NOT NULL)")
+            gram_ids = {}
+            gram_counts = collections.Counter()
+            count = 0
+            for identifiers in _iter_reference_chunks(reference_file):
+                rows = [(count + i, value, len(value)) for i, value in enumerate(identifiers)]
+                conn.executemany("INSERT INTO identifiers VALUES (?, ?, ?)", rows)
+                postings = [(gram_ids.setdefault(gram, len(gram_ids)), row_id)
+                            for row_id, value, _ in rows for gram in _identifier_grams(value)]
+                gram_counts.update(gram_id for gram_id, _ in postings)
+                conn.executemany("INSERT INTO gram_rows VALUES (?, ?)", postings)
+                count += len(rows)
+            # 数据写完后再建索引，比边插入边维护快得多
+            conn.execute("CREATE INDEX identifiers_value ON identifiers (value)")
+            conn.execute("CREATE TABLE gram_ids (gram TEXT PRIMARY KEY, gram_id INTEGER NOT NULL, n INTEGER NOT NULL) WITHOUT ROWID")
+            conn.executemany("INSERT INTO gram_ids VALUES (?, ?, ?)",
+                             ((gram, gram_id, gram_counts[gram_id]) for gram, gram_id in gram_ids.items()))
+            conn.execute("CREATE TABLE grams (gram_id INTEGER NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (gram_id, id)) WITHOUT ROWID")
+            conn.execute("INSERT INTO grams SELECT gram_id, id FROM gram_rows ORDER BY gram_id, id")
+            conn.execute("DROP TABLE gram_rows")
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [("count", str(count)), ("source_version", source_version)])
+            conn.commit()
+        finally:
+            conn.close()
+        print(f"标识符索引构建完成，共 {count} 个标识符")
+
+    def _conn(self):
+        # 每个线程使用独立的只读连接（服务模式下多个任务并发查询）
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.index_file}?mode=ro", uri=True)
+            self._local.conn = conn
+        return conn
+
+    def _meta(self, key):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return self._conn().execute("SELECT 1 FROM identifiers WHERE value = ? LIMIT 1", (key,)).fetchone() is not None
+
+    def fuzzy_candidates(self, key, cutoff=0.6, limit=FUZZY_CANDIDATE_LIMIT):
+        """返回可能与 key 相似度达到 cutoff 的候选标识符（按共享 3-gram 数降序，至多 limit 个）。"""
+        if not key:
+            return []
+        grams = sorted(_identifier_grams(key))
+        placeholders = ','.join('?' * len(grams))
+        freq = self._conn().execute(
+            f"SELECT gram_id FROM gram_ids WHERE gram IN ({placeholders}) ORDER BY n LIMIT ?",
+            (*grams, FUZZY_QUERY_GRAMS),
+        ).fetchall()
+        gram_ids = [row[0] for row in freq]
+        if not gram_ids:
+            return []
+        # difflib 的 ratio = 2M/(la+lb) <= 2*min(la,lb)/(la+lb)，据此限定候选长度范围
+        min_len = int(len(key) * cutoff / (2 - cutoff))
+        max_len = int(len(key) * (2 - cutoff) / cutoff) + 1
+        placeholders = ','.join('?' * len(gram_ids))
+        rows = self._conn().execute(
+            f"SELECT i.value FROM grams g JOIN identifiers i ON i.id = g.id "
+            f"WHERE g.gram_id IN ({placeholders}) AND i.len BETWEEN ? AND ? "
+            f"GROUP BY g.id ORDER BY COUNT(*) DESC LIMIT ?",
+            (*gram_ids, min_len, max_len, limit),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+# 参考表格解析缓存：(绝对路径) -> ((mtime_ns, size), 标识符列表)，长驻进程中重复任务无需重新解析；
+# 按最近使用顺序保留，超过 IDENTIFIER_CACHE_MAX_ENTRIES 个表格时淘汰最久未用的
+IDENTIFIER_CACHE_MAX_ENTRIES = 8
+_IDENTIFIER_CACHE = collections.OrderedDict()
+_IDENTIFIER_CACHE_LOCK = threading.Lock()
+
+def _load_identifiers(reference_file):
+    """读取参考表格的标识符列表（大表格返回 IdentifierIndex）；文件未变化（路径、修改时间、大小一致）时直接复用上次解析结果。"""
+    key = os.path.abspath(reference_file)
+    st = os.stat(key)
+    version = (st.st_mtime_ns, st.st_size)
+    with _IDENTIFIER_CACHE_LOCK:
+        cached = _IDENTIFIER_CACHE.get(key)
+        if cached and cached[0] == version:
+            _IDENTIFIER_CACHE.move_to_end(key)
+            return cached[1]
+    identifiers = None
+    if st.st_size > IDENTIFIER_INDEX_THRESHOLD_BYTES:
+        try:
+            identifiers = IdentifierIndex.for_reference(reference_file)
+        except (OSError, sqlite3.Error) as e:
+            print(f"无法使用磁盘标识符索引，改为全部载入内存: {e}")
+    if identifiers is None:
+        identifiers = _read_identifiers(reference_file)
+    with _IDENTIFIER_CACHE_LOCK:
+        _IDENTIFIER_CACHE[key] = (version, identifiers)
+        _IDENTIFIER_CACHE.move_to_end(key)
+        while len(_IDENTIFIER_CACHE) > IDENTIFIER_CACHE_MAX_ENTRIES:
+            _IDENTIFIER_CACHE.popitem(last=False)
+    return identifiers
+
+def _read_identifiers(reference_file):
+    """读取参考表格第一列，返回小写标识符列表；格式不支持时抛出 ValueError。"""
+    # 尝试读取Excel文件
+    if reference_file.endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(reference_file, header=0)
+    # 尝试读取CSV文件
+    elif reference_file.endswith('.csv'):
+        df = pd.read_csv(reference_file, header=0)
+    else:
+        raise ValueError("参考文件必须是Excel(.xlsx/.xls)或CSV(.csv)格式")
+
+    # 只读取第一列作为标识符
+    if len(df.columns) < 1:
+        raise ValueError("参考表格必须至少包含一列：标识符")
+
+    # 获取标识符列表
+    identifiers = []
+    for _, row in df.iterrows():
+        identifier = str(row[df.columns[0]]).strip()
+        if identifier:
+            identifiers.append(identifier.lower())
+    return identifiers
+
+def _tokenize_basename(basename):
+    """将文件名（不含扩展名）切分为候选标识符，最后附加完整文件名。"""
+    tokens = re.findall(r"\d+|[A-Za-z]+|[\u4e00-\u9fff]+", basename)
+    tokens.append(basename)
+    return tokens
+
+def _match_tokens(tokens, identifiers, filename):
+    """先精确、后模糊地在标识符中查找候选 token，返回匹配的标识符或 None。"""
+    for token in tokens:
+        key = token.lower()
+        if key in identifiers:
+            return key
+
+    # 模糊匹配（磁盘索引只对少量候选计算相似度）
+    for token in tokens:
+        key = token.lower()
+        candidates = identifiers.fuzzy_candidates(key, cutoff=0.6) if isinstance(identifiers, IdentifierIndex) else identifiers
+        closest = difflib.get_close_matches(key, candidates, n=1, cutoff=0.6)
+        if closest:
+            print(f"模糊匹配: {filename} 的标识 {token} -> {closest[0]}")
+            return closest[0]
+    return None
+
+def _describe_with_ai(source_file, filename, is_cancelled=None):
+    """AI 重命名前置检查并调用模型，返回描述文本或 None。"""
+    print(f"正在使用AI分析图片: {filename}")
+    # 对异常格式进行快速过滤：空文件、超大文件（> 50MB）直接跳过
+    try:
+        if os.path.getsize(source_file) <= 0 or os.path.getsize(source_file) > 50 * 1024 * 1024:
+            print(f"AI前置检查跳过(空或过大): {filename}")
+            return None
+    except Exception:
+        pass
+    return analyze_image_with_qwen(source_file, is_cancelled=is_cancelled)
+
+def _resolve_names(root, filename, identifier_sets, use_ai_naming=False, is_cancelled=None):
+    """针对多组标识符计算单个源文件的命名主干（标识符或AI描述），返回与 identifier_sets 对应的列表，不匹配或失败处为 None。
+
+    文件名只切分一次；AI 描述与参考表格无关，只分析一次并由各组共用。
+    """
+    basename, ext = os.path.splitext(filename)
+    source_file = os.path.join(root, filename)
+
+    # 检查是否为图片文件（包括RAW格式）
+    is_image = ext.lower() in IMAGE_EXTENSIONS or is_raw_format(source_file)
+
+    if use_ai_naming and is_image:
+        # 使用AI视觉理解重命名
+        ai_description = _describe_with_ai(source_file, filename, is_cancelled=is_cancelled)
+        if ai_description:
+            print(f"AI分析结果: {filename} -> {ai_description}{ext}")
+        else:
+            print(f"AI分析失败，跳过: {filename}")
+        return [ai_description] * len(identifier_sets)
+
+    # 使用原有的文件名匹配逻辑
+    tokens = _tokenize_basename(basename)
+    return [_match_tokens(tokens, identifiers, filename) for identifiers in identifier_sets]
+
+def _resolve_name(root, filename, identifiers, use_ai_naming=False, is_cancelled=None):
+    """计算单个源文件的命名主干（标识符或AI描述），不匹配或失败时返回 None。"""
+    return _resolve_names(root, filename, [identifiers], use_ai_naming=use_ai_naming, is_cancelled=is_cancelled)[0]
+
+def _unique_target_name(target_folder, new_filename, reserved=None):
+    """在目标目录中为 new_filename 选择不冲突的名称（_1、_2…），同时避开 reserved 中已占用的名称。
+
+    target_folder 为 None 时只检查 reserved（如写入归档）。
+    """
+    reserved = reserved if reserved is not None else set()
+
+    def _taken(name):
+        if name in reserved:
+            return True
+        return target_folder is not None and os.path.exists(os.path.join(target_folder, name))
+
+    if not _taken(new_filename):
+        return new_filename
+    name_without_ext, ext = os.path.splitext(new_filename)
+    counter = 1
+    while True:
+        candidate = f"{name_without_ext}_{counter}{ext}"
+        if not _taken(candidate):
+            return candidate
+        counter += 1
+
+def _claim_target_name(target_folder, new_filename):
+    """在目标目录中独占创建（O_EXCL）一个不冲突的空文件占住名称，返回该名称。
+
+    服务模式下多个任务可能同时写入同一目标目录，仅检查文件是否存在会让它们选中同一名称并互相覆盖；
+    先原子地占用名称、再复制到该文件中即可避免。
+    """
+    taken = set()
+    while True:
+        name = _unique_target_name(target_folder, new_filename, taken)
+        try:
+            fd = os.open(os.path.join(target_folder, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            taken.add(name)
+            continue
+        os.close(fd)
+        return name
+
+def _notify_progress(progress_callback, processed, total, matched, current):
+    if progress_callback:
+        try:
+            progress_callback(processed, total, matched, current)
+        except Exception:
+            pass
+
+def _process_single_file(root, filename, identifiers, target_folder, use_ai_naming=False, is_cancelled=None):
+    """匹配/命名单个文件并复制到目标目录，成功时返回目标文件名，不匹配或失败返回 None。
+
+    处理中途被取消时抛出 _OperationCancelled，未完成的目标文件已被删除。
+    """
+    source_file = os.path.join(root, filename)
+    name = _resolve_name(root, filename, identifiers, use_ai_naming=use_ai_naming, is_cancelled=is_cancelled)
+    if not name:
+        # 跳过不匹配或AI分析失败的文件
+        return None
+
+    # 处理文件名冲突：先占用目标文件名，并发任务不会选中同一名称
+    try:
+        new_filename = _claim_target_name(target_folder, f"{name}{os.path.splitext(filename)[1]}")
+    except OSError as e:
+        print(f"复制或校验失败，已跳过: {filename} -> {e}")
+        return None
+    target_file = os.path.join(target_folder, new_filename)
+
+    # 复制文件并重命名（带校验与重试）
+    try:
+        copied = _copy_with_verify(source_file, target_file, is_cancelled=is_cancelled)
+    except _OperationCancelled:
+        _remove_quietly(target_file)
+        raise
+    if copied:
+        print(f"已复制并重命名(校验通过): {filename} -> {new_filename}")
+        return new_filename
+    _remove_quietly(target_file)
+    print(f"复制或校验失败，已跳过: {filename}")
+    return None
+
 def process_files(source_folder, target_folder, reference_file, progress_callback=None, is_cancelled=None, use_ai_naming=False):
     """
     根据参考表格筛选文件，复制到目标文件夹并重命名
@@ -326,6 +1153,9 @@ def process_files(source_folder, target_folder, reference_file, progress_callbac
         target_folder: 目标文件夹路径，用于存放筛选后的文件
         reference_file: 参考表格文件路径，包含标识符和对应的备注
         use_ai_naming: 是否使用AI视觉理解进行重命名
+
+    返回:
+        成功复制的文件数；读取参考表格失败时返回 None
     """
     # 确保目标文件夹存在
     if not os.path.exists(target_folder):
@@ -334,26 +1164,7 @@ def process_files(source_folder, target_folder, reference_file, progress_callbac
     
     # 读取参考表格
     try:
-        # 尝试读取Excel文件
-        if reference_file.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(reference_file, header=0)
-        # 尝试读取CSV文件
-        elif reference_file.endswith('.csv'):
-            df = pd.read_csv(reference_file, header=0)
-        else:
-            raise ValueError("参考文件必须是Excel(.xlsx/.xls)或CSV(.csv)格式")
-        
-        # 只读取第一列作为标识符
-        if len(df.columns) < 1:
-            raise ValueError("参考表格必须至少包含一列：标识符")
-        
-        # 获取标识符列表
-        identifiers = []
-        for _, row in df.iterrows():
-            identifier = str(row[df.columns[0]]).strip()
-            if identifier:
-                identifiers.append(identifier.lower())
-
+        identifiers = _load_identifiers(reference_file)
         print(f"成功加载参考表格，共有{len(identifiers)}个有效标识符")
     except Exception as e:
         print(f"读取参考表格时出错: {e}")
@@ -364,141 +1175,1026 @@ def process_files(source_folder, target_folder, reference_file, progress_callbac
     processed_count = 0
     all_files = list(_iter_source_files(source_folder))
     total_files = len(all_files)
-    if progress_callback:
+    _notify_progress(progress_callback, processed_count, total_files, matched_count, None)
+    
+    for root, filename in all_files:
+        if is_cancelled and callable(is_cancelled) and is_cancelled():
+            print("处理已被用户取消")
+            break
+
         try:
-            progress_callback(processed_count, total_files, matched_count, None)
-        except Exception:
-            pass
+            if _process_single_file(root, filename, identifiers, target_folder, use_ai_naming=use_ai_naming, is_cancelled=is_cancelled):
+                matched_count += 1
+        except _OperationCancelled:
+            print(f"处理已被用户取消（已中止 {filename}）")
+            break
+        
+        # 进度更新
+        processed_count += 1
+        _notify_progress(progress_callback, processed_count, total_files, matched_count, filename)
     
+    print(f"\n处理完成! 共找到并处理了{matched_count}个匹配的文件")
+    if matched_count == 0:
+        print("没有找到匹配的文件，请检查源文件夹中的文件名与参考表格中的标识符是否一致")
+    _report_ai_rate(use_ai_naming)
+    return matched_count
+
+def process_files_multi(source_folder, jobs, progress_callback=None, is_cancelled=None, use_ai_naming=False):
+    """
+    一次扫描源文件夹，同时按多个参考表格筛选并复制到各自的目标文件夹
+
+    每个文件只遍历、切分一次，再分别与各参考表格匹配；同一文件命中多个目标时，
+    源文件只读取一次并同时写入所有目标。
+
+    参数:
+        source_folder: 源文件夹路径
+        jobs: [(参考表格路径, 目标文件夹路径), ...]
+        use_ai_naming: 是否使用AI视觉理解进行重命名（图片只分析一次，各目标共用描述）
+
+    返回:
+        与 jobs 一一对应的成功复制文件数列表；任一参考表格读取失败时返回 None
+    """
+    identifier_sets = []
+    for reference_file, target_folder in jobs:
+        try:
+            identifiers = _load_identifiers(reference_file)
+            print(f"成功加载参考表格 {reference_file}，共有{len(identifiers)}个有效标识符")
+        except Exception as e:
+            print(f"读取参考表格时出错 {reference_file}: {e}")
+            return None
+        identifier_sets.append(identifiers)
+        if not os.path.exists(target_folder):
+            os.makedirs(target_folder)
+            print(f"已创建目标文件夹: {target_folder}")
+    # 同一目录的不同写法（out 与 out/、相对与绝对路径、符号链接）归一化为同一个键
+    target_keys = [os.path.normcase(os.path.realpath(target_folder)) for _, target_folder in jobs]
+
+    matched_counts = [0] * len(jobs)
+    matched_total = 0
+    processed_count = 0
+    all_files = list(_iter_source_files(source_folder))
+    total_files = len(all_files)
+    _notify_progress(progress_callback, processed_count, total_files, matched_total, None)
+
     for root, filename in all_files:
         if is_cancelled and callable(is_cancelled) and is_cancelled():
             print("处理已被用户取消")
             break
 
-        basename, ext = os.path.splitext(filename)
         source_file = os.path.join(root, filename)
-        ai_temp_jpg_path = None
-        
-        # 检查是否为图片文件（包括RAW格式）
-        is_image = ext.lower() in IMAGE_EXTENSIONS or is_raw_format(source_file)
-        
-        if use_ai_naming and is_image:
-            # 使用AI视觉理解重命名
-            print(f"正在使用AI分析图片: {filename}")
-            # 对异常格式进行快速过滤：空文件、超大文件（> 50MB）直接跳过
-            try:
-                if os.path.getsize(source_file) <= 0 or os.path.getsize(source_file) > 50 * 1024 * 1024:
-                    print(f"AI前置检查跳过(空或过大): {filename}")
-                    ai_description = None
+        ext = os.path.splitext(filename)[1]
+        try:
+            names = _resolve_names(root, filename, identifier_sets, use_ai_naming=use_ai_naming, is_cancelled=is_cancelled)
+            job_indexes = [i for i, name in enumerate(names) if name]
+            target_files = []
+            chosen = set()  # (目标目录键, 文件名)
+            for i in job_indexes:
+                target_folder = jobs[i][1]
+                # 多个任务共用同一目标文件夹时，避开本文件刚为其他任务选定的名称
+                reserved = {name for key, name in chosen if key == target_keys[i]}
+                new_filename = _unique_target_name(target_folder, f"{names[i]}{ext}", reserved)
+                chosen.add((target_keys[i], new_filename))
+                target_files.append(os.path.join(target_folder, new_filename))
+            results = _copy_to_many_with_verify(source_file, target_files, is_cancelled=is_cancelled) if target_files else []
+        except _OperationCancelled:
+            print(f"处理已被用户取消（已中止 {filename}）")
+            break
+        if job_indexes:
+            for i, target_file, success in zip(job_indexes, target_files, results):
+                if success:
+                    print(f"已复制并重命名(校验通过): {filename} -> {target_file}")
+                    matched_counts[i] += 1
                 else:
-                    ai_description = analyze_image_with_qwen(source_file)
-            except Exception:
-                ai_description = analyze_image_with_qwen(source_file)
-            if ai_description:
-                new_filename = f"{ai_description}{ext}"
-                print(f"AI分析结果: {filename} -> {new_filename}")
-            else:
-                print(f"AI分析失败，跳过: {filename}")
-                processed_count += 1
-                if progress_callback:
-                    try:
-                        progress_callback(processed_count, total_files, matched_count, filename)
-                    except Exception:
-                        pass
-                continue
+                    print(f"复制或校验失败，已跳过: {filename} -> {jobs[i][1]}")
+            if any(results):
+                matched_total += 1
+
+        processed_count += 1
+        _notify_progress(progress_callback, processed_count, total_files, matched_total, filename)
+
+    print(f"\n处理完成! 共扫描 {processed_count} 个文件")
+    for (reference_file, target_folder), count in zip(jobs, matched_counts):
+        print(f"  {reference_file} -> {target_folder}: {count} 个匹配的文件")
+    _report_ai_rate(use_ai_naming)
+    return matched_counts
+
+# 已压缩的图片/RAW 格式在归档中直接存储（ZIP_STORED），其余文件使用 deflate
+_STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif'} | RAW_EXTENSIONS
+# 归档内的校验清单（sha256sum 格式），写在所有条目之后
+ARCHIVE_MANIFEST_NAME = 'SHA256SUMS'
+
+def _archive_format_for(archive_file, archive_format=None):
+    """确定归档格式（zip/tar），未指定时按扩展名推断。"""
+    archive_format = archive_format or ('tar' if archive_file.lower().endswith('.tar') else 'zip')
+    if archive_format not in ('zip', 'tar'):
+        raise ValueError(f"不支持的归档格式: {archive_format}")
+    return archive_format
+
+class _HashingReader:
+    """读取源文件时同步计算 SHA-256 并检查取消标志（供 tarfile.addfile 读取）。"""
+
+    def __init__(self, fileobj, is_cancelled=None):
+        self._fileobj = fileobj
+        self._is_cancelled = is_cancelled
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        _raise_if_cancelled(self._is_cancelled)
+        data = self._fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+def _write_archive_entry(archive, archive_format, fsrc, arcname, is_cancelled=None, chunk_size=1024 * 1024):
+    """将已打开的源文件流式写入归档条目，单次读取同时计算 SHA-256，返回十六进制摘要。
+
+    源文件由调用方先打开：打不开的文件在写入任何归档内容之前就能被跳过。
+    """
+    # 以打开后的句柄大小为准；写完后再读一个字节确认已到文件末尾，避免文件增长时被静默截断
+    expected = os.fstat(fsrc.fileno()).st_size
+    if archive_format == 'tar':
+        tarinfo = archive.gettarinfo(arcname=arcname, fileobj=fsrc)
+        tarinfo.size = expected
+        reader = _HashingReader(fsrc, is_cancelled)
+        archive.addfile(tarinfo, fileobj=reader)
+        if reader.size != expected or fsrc.read(1):
+            raise IOError("写入归档时文件大小发生变化")
+        return reader.sha256.hexdigest()
+
+    # 1980 年以前的修改时间（ZIP 无法表示）按 1980-01-01 记录，不因单个文件中止整个归档
+    zinfo = zipfile.ZipInfo.from_file(fsrc.name, arcname=arcname, strict_timestamps=False)
+    zinfo.file_size = expected
+    ext = os.path.splitext(arcname)[1].lower()
+    zinfo.compress_type = zipfile.ZIP_STORED if ext in _STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+    sha256 = hashlib.sha256()
+    written = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    # file_size 已知，zipfile 会在需要时自动使用 ZIP64 扩展
+    with archive.open(zinfo, 'w') as fdst:
+        while written < expected:
+            _raise_if_cancelled(is_cancelled)
+            n = fsrc.readinto(view[:min(chunk_size, expected - written)])
+            if not n:
+                break
+            sha256.update(view[:n])
+            fdst.write(view[:n])
+            written += n
+    if written != expected or fsrc.read(1):
+        raise IOError("写入归档时文件大小发生变化")
+    return sha256.hexdigest()
+
+def process_files_to_archive(source_folder, archive_file, reference_file, archive_format=None,
+                             progress_callback=None, is_cancelled=None, use_ai_naming=False):
+    """
+    根据参考表格筛选文件，直接流式写入 ZIP(ZIP64)/TAR 归档，不在目标卷上生成单个文件
+
+    归档内的文件名与 process_files 复制到空目标文件夹时的命名一致；每个条目写入时同步计算
+    SHA-256，结束时写入 SHA256SUMS 清单。先写入 .part 临时文件，完成后再重命名，取消或出错时删除。
+
+    参数:
+        archive_file: 输出归档路径
+        archive_format: 'zip' 或 'tar'，默认按扩展名推断（非 .tar 均为 zip）
+
+    返回:
+        写入归档的文件数（取消时为 0）；读取参考表格或写入归档失败时返回 None
+    """
+    archive_format = _archive_format_for(archive_file, archive_format)
+    try:
+        identifiers = _load_identifiers(reference_file)
+        print(f"成功加载参考表格，共有{len(identifiers)}个有效标识符")
+    except Exception as e:
+        print(f"读取参考表格时出错: {e}")
+        return None
+
+    matched_count = 0
+    processed_count = 0
+    all_files = list(_iter_source_files(source_folder))
+    total_files = len(all_files)
+    _notify_progress(progress_callback, processed_count, total_files, matched_count, None)
+
+    part_file = archive_file + '.part'
+    reserved = {ARCHIVE_MANIFEST_NAME}
+    checksums = []
+    try:
+        if archive_format == 'tar':
+            archive = tarfile.open(part_file, 'w', format=tarfile.PAX_FORMAT)
         else:
-            # 使用原有的文件名匹配逻辑
-            tokens = re.findall(r"\d+|[A-Za-z]+|[\u4e00-\u9fff]+", basename)
-            tokens.append(basename)
-            
-            matched_identifier = None
-            for token in tokens:
-                key = token.lower()
-                if key in identifiers:
-                    matched_identifier = key
-                    break
-            
-            if not matched_identifier:
-                # 模糊匹配
-                for token in tokens:
-                    key = token.lower()
-                    closest = difflib.get_close_matches(key, identifiers, n=1, cutoff=0.6)
-                    if closest:
-                        matched_identifier = closest[0]
-                        print(f"模糊匹配: {filename} 的标识 {token} -> {matched_identifier}")
-                        break
-            
-            if not matched_identifier:
-                # 跳过不匹配的文件
+            archive = zipfile.ZipFile(part_file, 'w', allowZip64=True)
+        with archive:
+            for root, filename in all_files:
+                if is_cancelled and callable(is_cancelled) and is_cancelled():
+                    raise _OperationCancelled()
+
+                name = _resolve_name(root, filename, identifiers, use_ai_naming=use_ai_naming, is_cancelled=is_cancelled)
+                if name:
+                    # 先打开源文件：无法读取（权限不足、扫描后被删除）时跳过该文件，归档尚未写入任何内容
+                    try:
+                        fsrc = open(os.path.join(root, filename), 'rb')
+                    except OSError as e:
+                        print(f"复制或校验失败，已跳过: {filename} -> {e}")
+                        fsrc = None
+                    if fsrc is not None:
+                        with fsrc:
+                            arcname = _unique_target_name(None, f"{name}{os.path.splitext(filename)[1]}", reserved)
+                            reserved.add(arcname)
+                            digest = _write_archive_entry(archive, archive_format, fsrc, arcname, is_cancelled)
+                        checksums.append((digest, arcname))
+                        matched_count += 1
+                        print(f"已写入归档: {filename} -> {arcname}")
+
                 processed_count += 1
-                if progress_callback:
+                _notify_progress(progress_callback, processed_count, total_files, matched_count, filename)
+
+            manifest = ''.join(f"{digest}  {arcname}\n" for digest, arcname in checksums).encode('utf-8')
+            if archive_format == 'tar':
+                tarinfo = tarfile.TarInfo(ARCHIVE_MANIFEST_NAME)
+                tarinfo.size = len(manifest)
+                tarinfo.mtime = int(time.time())
+                archive.addfile(tarinfo, io.BytesIO(manifest))
+            else:
+                archive.writestr(ARCHIVE_MANIFEST_NAME, manifest)
+        os.replace(part_file, archive_file)
+    except _OperationCancelled:
+        print("处理已被用户取消，已删除未完成的归档")
+        _remove_quietly(part_file)
+        return 0
+    except Exception as e:  # noqa: BLE001
+        print(f"写入归档失败: {e}")
+        _remove_quietly(part_file)
+        return None
+
+    print(f"\n处理完成! 共将{matched_count}个匹配的文件写入归档: {archive_file}")
+    _report_ai_rate(use_ai_naming)
+    return matched_count
+
+PLAN_FORMAT_VERSION = 2
+
+def build_plan(source_folder, target_folder, reference_file, progress_callback=None, is_cancelled=None, use_ai_naming=False):
+    """
+    扫描并匹配源文件，生成复制计划（不执行复制）
+
+    目标文件名在此一次性确定（同时避开目标目录已有文件与计划内的其他条目），
+    因此任意分片执行时得到的名称都是确定且互不冲突的。
+
+    条目中的 source 为相对源目录的路径（以 / 分隔），执行时可换用其他挂载点下的同一源目录。
+
+    返回:
+        计划条目列表，每项为 {"source", "size", "identifier", "target"}；读取参考表格失败或被取消时返回 None
+        （不完整的扫描结果不能作为计划写出）
+    """
+    try:
+        identifiers = _load_identifiers(reference_file)
+        print(f"成功加载参考表格，共有{len(identifiers)}个有效标识符")
+    except Exception as e:
+        print(f"读取参考表格时出错: {e}")
+        return None
+
+    entries = []
+    reserved = set()
+    processed_count = 0
+    # 排序保证同一源目录多次生成的计划一致
+    all_files = sorted(_iter_source_files(source_folder))
+    total_files = len(all_files)
+    _notify_progress(progress_callback, processed_count, total_files, len(entries), None)
+
+    for root, filename in all_files:
+        if is_cancelled and callable(is_cancelled) and is_cancelled():
+            print("生成计划已被用户取消")
+            return None
+
+        try:
+            name = _resolve_name(root, filename, identifiers, use_ai_naming=use_ai_naming, is_cancelled=is_cancelled)
+        except _OperationCancelled:
+            print("生成计划已被用户取消")
+            return None
+        if name:
+            source_file = os.path.join(root, filename)
+            new_filename = _unique_target_name(target_folder, f"{name}{os.path.splitext(filename)[1]}", reserved)
+            reserved.add(new_filename)
+            try:
+                size = os.path.getsize(source_file)
+            except OSError:
+                size = -1
+            relative = os.path.relpath(source_file, source_folder).replace(os.sep, '/')
+            entries.append({"source": relative, "size": size, "identifier": name, "target": new_filename})
+
+        processed_count += 1
+        _notify_progress(progress_callback, processed_count, total_files, len(entries), filename)
+
+    _report_ai_rate(use_ai_naming)
+    return entries
+
+def write_plan(plan_file, source_folder, target_folder, entries):
+    """将计划写为 JSON Lines：首行为头信息（版本、源目录、目标目录、条目数），其后每行一个条目。"""
+    with open(plan_file, 'w', encoding='utf-8') as f:
+        header = {"version": PLAN_FORMAT_VERSION, "source": os.path.abspath(source_folder),
+                  "target": os.path.abspath(target_folder), "count": len(entries)}
+        f.write(json.dumps(header, ensure_ascii=False, separators=(',', ':')) + "\n")
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+def read_plan(plan_file):
+    """读取计划文件，返回 (头信息, 条目列表)。"""
+    with open(plan_file, 'r', encoding='utf-8') as f:
+        lines = [line for line in f if line.strip()]
+    if not lines:
+        raise ValueError("计划文件为空")
+    header = json.loads(lines[0])
+    if header.get("version") != PLAN_FORMAT_VERSION:
+        raise ValueError(f"不支持的计划文件版本: {header.get('version')}")
+    entries = [json.loads(line) for line in lines[1:]]
+    if len(entries) != header.get("count", len(entries)):
+        raise ValueError("计划文件条目数与头信息不一致，文件可能被截断")
+    return header, entries
+
+def parse_shard(spec):
+    """解析 "i/N" 形式的分片参数（i 从 0 开始），返回 (i, N)。"""
+    try:
+        index_text, count_text = spec.split('/', 1)
+        index, count = int(index_text), int(count_text)
+    except Exception:
+        raise ValueError(f"分片参数格式应为 i/N: {spec}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"分片参数超出范围: {spec}")
+    return index, count
+
+def _apply_plan_entry(entry, source_folder, target_folder, is_cancelled=None):
+    """执行单个计划条目，成功复制或目标已一致时返回 True。"""
+    source_file = os.path.join(source_folder, *entry["source"].split('/'))
+    target_file = os.path.join(target_folder, entry["target"])
+    filename = os.path.basename(source_file)
+    try:
+        source_size = os.path.getsize(source_file)
+    except OSError as e:
+        print(f"源文件不可读，已跳过: {source_file} -> {e}")
+        return False
+
+    if source_size != entry["size"]:
+        print(f"源文件大小与计划不一致（计划后被修改?），已跳过: {source_file}")
+        return False
+    if os.path.exists(target_file):
+        try:
+            identical = (os.path.getsize(target_file) == source_size
+                         and _compute_sha256(target_file, is_cancelled=is_cancelled) == _compute_sha256(source_file, is_cancelled=is_cancelled))
+        except OSError as e:
+            print(f"目标已存在但无法校验，已跳过: {entry['target']} -> {e}")
+            return False
+        if identical:
+            print(f"目标已存在且一致，跳过复制: {entry['target']}")
+            return True
+        print(f"目标已存在但内容不同，已跳过: {entry['target']}")
+        return False
+    if _copy_with_verify(source_file, target_file, is_cancelled=is_cancelled):
+        print(f"已复制并重命名(校验通过): {filename} -> {entry['target']}")
+        return True
+    print(f"复制或校验失败，已跳过: {filename}")
+    return False
+
+def apply_plan(plan_file, shard_index=0, shard_count=1, target_folder=None, progress_callback=None, is_cancelled=None,
+               source_folder=None):
+    """
+    执行计划文件（或其中一个分片）
+
+    条目按在计划中的序号取模分配到分片，多台机器/多个进程可共享同一存储并行执行。
+    目标文件已存在且内容一致时视为已完成（便于重跑），不一致则跳过并报告，不会另行改名。
+
+    参数:
+        plan_file: build_plan/write_plan 生成的计划文件
+        shard_index, shard_count: 当前分片序号（从0开始）与分片总数
+        target_folder: 覆盖计划中记录的目标目录（各节点挂载路径不同时使用）
+        source_folder: 覆盖计划中记录的源目录（同上）
+
+    返回:
+        成功复制（或已存在且一致）的文件数
+    """
+    header, entries = read_plan(plan_file)
+    target_folder = target_folder or header["target"]
+    source_folder = source_folder or header["source"]
+    if not os.path.exists(target_folder):
+        os.makedirs(target_folder, exist_ok=True)
+        print(f"已创建目标文件夹: {target_folder}")
+
+    shard = [entry for i, entry in enumerate(entries) if i % shard_count == shard_index]
+    total = len(shard)
+    done_count = 0
+    processed_count = 0
+    _notify_progress(progress_callback, processed_count, total, done_count, None)
+
+    for entry in shard:
+        if is_cancelled and callable(is_cancelled) and is_cancelled():
+            print("处理已被用户取消")
+            break
+
+        filename = os.path.basename(entry["source"])
+        try:
+            if _apply_plan_entry(entry, source_folder, target_folder, is_cancelled=is_cancelled):
+                done_count += 1
+        except _OperationCancelled:
+            print(f"处理已被用户取消（已中止 {filename}）")
+            break
+
+        processed_count += 1
+        _notify_progress(progress_callback, processed_count, total, done_count, filename)
+
+    print(f"\n分片 {shard_index}/{shard_count} 执行完成! 成功 {done_count}/{total} 个文件")
+    return done_count
+
+# AI 命名时在源目录旁生成的临时文件，监听模式下需忽略
+_TEMP_FILE_SUFFIXES = ('_temp.jpg', '_compressed.jpg')
+# 监听模式记录已处理文件签名的条目上限，超出时淘汰最早的记录
+WATCH_PROCESSED_MAX = 200000
+# 监听模式清理已删除/移走文件记录的间隔（秒）
+WATCH_PRUNE_INTERVAL_S = 600
+
+def _file_signatures(paths):
+    """返回 {路径: (大小, 修改时间ns)}，跳过无法访问的文件。"""
+    signatures = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signatures[path] = (st.st_size, st.st_mtime_ns)
+    return signatures
+
+class _PollingWatcher:
+    """轮询方式的目录监听：定期比较 (大小, 修改时间) 快照，作为 inotify 不可用时的回退。"""
+
+    def __init__(self, root, interval_s=1.0):
+        self.root = root
+        self.interval_s = interval_s
+        self._snapshot = self._scan()
+        # 启动时已存在的文件及其签名
+        self.initial_snapshot = dict(self._snapshot)
+
+    def _scan(self):
+        return _file_signatures(os.path.join(root, filename) for root, filename in _iter_source_files(self.root))
+
+    def changes(self, timeout):
+        """等待至多 timeout 秒，返回新增或变化的文件路径。"""
+        time.sleep(min(timeout, self.interval_s))
+        current = self._scan()
+        changed = [path for path, sig in current.items() if self._snapshot.get(path) != sig]
+        self._snapshot = current
+        return changed
+
+    def close(self):
+        pass
+
+class _InotifyWatcher:
+    """基于 Linux inotify 的递归目录监听（通过 ctypes 调用 libc，无额外依赖）。"""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    _MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self._ctypes = ctypes
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self._dirs = {}
+        # 启动时已存在的文件及其签名
+        self.initial_snapshot = _file_signatures(self._add_tree(root))
+
+    def _add_dir(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self._MASK)
+        if wd < 0:
+            raise OSError(self._ctypes.get_errno(), f"无法监听目录: {path}")
+        self._dirs[wd] = path
+
+    def _add_tree(self, path):
+        """监听 path 及其全部子目录，返回其中已存在的文件（覆盖建目录与加监听之间的竞态）。"""
+        existing = []
+        for root, dirnames, files in os.walk(path):
+            self._add_dir(root)
+            existing.extend(os.path.join(root, f) for f in files)
+        return existing
+
+    def changes(self, timeout):
+        """等待至多 timeout 秒，返回新增或变化的文件路径；事件队列溢出时返回 None 以触发全量扫描。"""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset + self._EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            parent = self._dirs.get(wd)
+            if parent is None or not name:
+                continue
+            path = os.path.join(parent, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
                     try:
-                        progress_callback(processed_count, total_files, matched_count, filename)
-                    except Exception:
-                        pass
+                        changed.extend(self._add_tree(path))
+                    except OSError as e:
+                        print(f"监听新目录失败: {path} -> {e}")
                 continue
-            
-            new_filename = f"{matched_identifier}{ext}"
-        
-        # 处理文件名冲突
-        target_file = os.path.join(target_folder, new_filename)
-        if os.path.exists(target_file):
-            counter = 1
-            while True:
-                name_without_ext = os.path.splitext(new_filename)[0]
-                candidate = f"{name_without_ext}_{counter}{os.path.splitext(new_filename)[1]}"
-                candidate_path = os.path.join(target_folder, candidate)
-                if not os.path.exists(candidate_path):
-                    new_filename = candidate
-                    target_file = candidate_path
-                    break
-                counter += 1
+            changed.append(path)
+        return changed
 
-        # 复制文件并重命名（带校验与重试）
-        success = _copy_with_verify(source_file, target_file)
-        if success:
-            print(f"已复制并重命名(校验通过): {filename} -> {new_filename}")
-            matched_count += 1
-        else:
-            print(f"复制或校验失败，已跳过: {filename}")
-        
-        # 进度更新
-        processed_count += 1
-        if progress_callback:
+    def close(self):
+        try:
+            os.close(self._fd)
+        except OSError:
+            pass
+
+def _create_watcher(source_folder, poll_interval_s, force_polling=False):
+    if not force_polling and sys.platform.startswith('linux'):
+        try:
+            return _InotifyWatcher(source_folder)
+        except Exception as e:  # noqa: BLE001
+            print(f"inotify 不可用，改用轮询监听: {e}")
+    return _PollingWatcher(source_folder, poll_interval_s)
+
+def watch_folder(source_folder, target_folder, reference_file, use_ai_naming=False, settle_s=2.0,
+                 poll_interval_s=1.0, is_cancelled=None, progress_callback=None, force_polling=False):
+    """
+    持续监听源文件夹，新文件写入完成后立即匹配、复制校验（可选AI命名）
+
+    参考表格只加载一次；启动时已存在的文件不处理（可先执行一次普通模式）。
+    文件在 settle_s 秒内大小与修改时间均不再变化才视为写入完成，避免处理半写入的文件。
+
+    参数:
+        settle_s: 判定写入完成所需的静止时间（秒）
+        poll_interval_s: 轮询回退模式的扫描间隔（秒）
+        is_cancelled: 返回 True 时停止监听
+        force_polling: 强制使用轮询（如网络文件系统上 inotify 收不到远端写入）
+    """
+    if not os.path.exists(target_folder):
+        os.makedirs(target_folder)
+        print(f"已创建目标文件夹: {target_folder}")
+
+    try:
+        identifiers = _load_identifiers(reference_file)
+        print(f"成功加载参考表格，共有{len(identifiers)}个有效标识符")
+    except Exception as e:
+        print(f"读取参考表格时出错: {e}")
+        return
+
+    target_abs = os.path.abspath(target_folder)
+    watcher = _create_watcher(source_folder, poll_interval_s, force_polling=force_polling)
+    print(f"开始监听: {source_folder}（{'inotify' if isinstance(watcher, _InotifyWatcher) else '轮询'}），按 Ctrl+C 停止")
+
+    def _wanted(path):
+        name = os.path.basename(path)
+        if name.startswith('.') or name.endswith(_TEMP_FILE_SUFFIXES):
+            return False
+        # 目标目录位于源目录内时，忽略自身产生的文件
+        return not os.path.abspath(path).startswith(target_abs + os.sep)
+
+    pending = {}    # path -> (签名, 签名最近一次变化的时间)
+    # path -> 处理时的签名，内容未变化时不重复处理；启动时已存在的文件视为已处理（事件队列溢出全量扫描时也不会复制）
+    processed = collections.OrderedDict(watcher.initial_snapshot)
+    last_prune = time.monotonic()
+    matched_count = 0
+    processed_count = 0
+    try:
+        while not (is_cancelled and callable(is_cancelled) and is_cancelled()):
+            # 长时间运行时定期清理已删除/移走的文件，并限制记录总数
+            if time.monotonic() - last_prune > WATCH_PRUNE_INTERVAL_S:
+                for path in [p for p in processed if not os.path.exists(p)]:
+                    del processed[path]
+                last_prune = time.monotonic()
+            while len(processed) > WATCH_PROCESSED_MAX:
+                processed.popitem(last=False)
+
+            timeout = min(poll_interval_s, settle_s / 2) if pending else poll_interval_s
+            changed = watcher.changes(timeout)
+            if changed is None:
+                print("监听事件队列溢出，执行一次全量扫描")
+                changed = [os.path.join(r, f) for r, f in _iter_source_files(source_folder)]
+            now = time.monotonic()
+            for path in changed:
+                if _wanted(path) and path not in pending:
+                    pending[path] = (None, now)
+
+            for path, (last_sig, since) in list(pending.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    pending.pop(path)
+                    continue
+                sig = (st.st_size, st.st_mtime_ns)
+                if sig != last_sig:
+                    pending[path] = (sig, now)
+                    continue
+                if now - since < settle_s:
+                    continue
+                pending.pop(path)
+                if processed.get(path) == sig:
+                    continue
+                processed[path] = sig
+                processed.move_to_end(path)
+                root, filename = os.path.split(path)
+                if _process_single_file(root, filename, identifiers, target_folder, use_ai_naming=use_ai_naming, is_cancelled=is_cancelled):
+                    matched_count += 1
+                processed_count += 1
+                _notify_progress(progress_callback, processed_count, processed_count, matched_count, filename)
+    except (KeyboardInterrupt, _OperationCancelled):
+        pass
+    finally:
+        watcher.close()
+    print(f"\n监听已停止，共处理 {processed_count} 个新文件，其中 {matched_count} 个匹配并复制")
+    _report_ai_rate(use_ai_naming)
+
+class _JobLogRouter(io.TextIOBase):
+    """替换 sys.stdout：任务线程中的输出写入对应任务日志，其余线程照常输出。"""
+
+    def __init__(self, fallback):
+        self._fallback = fallback
+        self._local = threading.local()
+
+    def bind(self, job):
+        self._local.job = job
+
+    def write(self, text):
+        job = getattr(self._local, 'job', None)
+        if job is None:
+            return self._fallback.write(text)
+        job.append_log(text)
+        return len(text)
+
+    def flush(self):
+        self._fallback.flush()
+
+class _Job:
+    """服务模式中的单个 process_files 任务及其状态。"""
+
+    LOG_MAX_LINES = 500
+
+    def __init__(self, job_id, source, target, reference, use_ai_naming):
+        self.id = job_id
+        self.source = source
+        self.target = target
+        self.reference = reference
+        self.use_ai_naming = use_ai_naming
+        self.state = 'queued'
+        self.error = None
+        self.matched = None
+        self.progress = {"processed": 0, "total": 0, "matched": 0, "current": None}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        self._log = []
+        self._partial = ''
+        self._lock = threading.Lock()
+
+    def append_log(self, text):
+        with self._lock:
+            lines = (self._partial + text).split('\n')
+            self._partial = lines.pop()
+            self._log.extend(line for line in lines if line.strip())
+            del self._log[:-self.LOG_MAX_LINES]
+
+    def to_dict(self, include_log=False):
+        with self._lock:
+            data = {
+                "id": self.id,
+                "state": self.state,
+                "source": self.source,
+                "target": self.target,
+                "reference": self.reference,
+                "ai_naming": self.use_ai_naming,
+                "progress": dict(self.progress),
+                "matched": self.matched,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+            if include_log:
+                data["log"] = list(self._log)
+        return data
+
+class JobServer:
+    """
+    长驻任务服务：在固定大小的线程池中执行 process_files 任务
+
+    进程内复用已解析的参考表格（按路径与修改时间缓存）、AI 请求的 HTTP 连接以及已加载的依赖库，
+    适合编排系统频繁提交小任务的场景。
+    """
+
+    def __init__(self, max_workers=2, max_finished_jobs=1000):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='photo-filter-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._max_finished_jobs = max_finished_jobs
+        self._log_router = None
+
+    def submit(self, source, target, reference, use_ai_naming=False):
+        """提交任务，返回任务状态字典；路径无效时抛出 ValueError。"""
+        error = _check_paths(source, target, reference)
+        if error:
+            raise ValueError(error)
+        with self._lock:
+            job = _Job(str(self._next_id), source, target, reference, use_ai_naming)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._prune_finished()
+        self._executor.submit(self._run, job)
+        return job.to_dict()
+
+    def get(self, job_id, include_log=True):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job.to_dict(include_log=include_log) if job else None
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.to_dict() for job in jobs]
+
+    def cancel(self, job_id):
+        """请求取消任务：排队中的任务不再执行，运行中的任务立即中止当前文件（清理未完成的输出）后停止。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job.cancel_requested = True
+        return job.to_dict()
+
+    def wait(self, job_id, timeout=None):
+        """阻塞等待任务结束（主要用于测试与嵌入式调用），返回任务状态字典。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            status = self.get(job_id, include_log=False)
+            if status is None or status["state"] in ('done', 'failed', 'cancelled'):
+                return status
+            if deadline is not None and time.monotonic() > deadline:
+                return status
+            time.sleep(0.05)
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel_requested = True
+        self._executor.shutdown(wait=True)
+        if self._log_router is not None and sys.stdout is self._log_router:
+            sys.stdout = self._log_router._fallback
+
+    def _prune_finished(self):
+        finished = [j for j in self._jobs.values() if j.state in ('done', 'failed', 'cancelled')]
+        for job in finished[:max(0, len(finished) - self._max_finished_jobs)]:
+            del self._jobs[job.id]
+
+    def _run(self, job):
+        if job.cancel_requested:
+            job.state = 'cancelled'
+            job.finished_at = time.time()
+            return
+        # 首个任务运行时安装日志路由，任务的 print 输出只进入各自日志
+        with self._lock:
+            if self._log_router is None:
+                self._log_router = _JobLogRouter(sys.stdout)
+                sys.stdout = self._log_router
+        self._log_router.bind(job)
+        job.state = 'running'
+        job.started_at = time.time()
+
+        def _progress_cb(processed, total, matched, current):
+            job.progress = {"processed": processed, "total": total, "matched": matched, "current": current}
+
+        try:
+            job.matched = process_files(
+                job.source,
+                job.target,
+                job.reference,
+                progress_callback=_progress_cb,
+                is_cancelled=lambda: job.cancel_requested,
+                use_ai_naming=job.use_ai_naming,
+            )
+            if job.matched is None:
+                job.state = 'failed'
+                job.error = "读取参考表格失败"
+            else:
+                job.state = 'cancelled' if job.cancel_requested else 'done'
+        except Exception as exc:  # noqa: BLE001
+            job.state = 'failed'
+            job.error = str(exc)
+        finally:
+            job.finished_at = time.time()
+            self._log_router.bind(None)
+
+# 服务模式 POST 请求体的长度上限（任务参数只有几个路径，1 MiB 足够）
+JOB_REQUEST_MAX_BYTES = 1024 * 1024
+
+class _JobRequestHandler(BaseHTTPRequestHandler):
+    """JobServer 的 HTTP 接口：
+    POST /jobs、GET /jobs、GET /jobs/<id>、POST /jobs/<id>/cancel
+    """
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _path_parts(self):
+        return [part for part in self.path.split('?', 1)[0].split('/') if part]
+
+    def do_GET(self):
+        parts = self._path_parts()
+        jobs = self.server.job_server
+        if parts == ['jobs']:
+            return self._send_json(200, {"jobs": jobs.list()})
+        if len(parts) == 2 and parts[0] == 'jobs':
+            status = jobs.get(parts[1])
+            if status is None:
+                return self._send_json(404, {"error": "任务不存在"})
+            return self._send_json(200, status)
+        return self._send_json(404, {"error": "未知路径"})
+
+    def do_POST(self):
+        parts = self._path_parts()
+        jobs = self.server.job_server
+        if parts == ['jobs']:
             try:
-                progress_callback(processed_count, total_files, matched_count, filename)
-            except Exception:
-                pass
-    
-    print(f"\n处理完成! 共找到并处理了{matched_count}个匹配的文件")
-    if matched_count == 0:
-        print("没有找到匹配的文件，请检查源文件夹中的文件名与参考表格中的标识符是否一致")
+                length = int(self.headers.get('Content-Length') or 0)
+                if not 0 <= length <= JOB_REQUEST_MAX_BYTES:
+                    raise ValueError(f"请求体长度无效: {length}")
+                params = json.loads(self.rfile.read(length) or b'{}')
+                status = jobs.submit(
+                    params['source'],
+                    params['target'],
+                    params['reference'],
+                    use_ai_naming=bool(params.get('ai_naming', False)),
+                )
+            except (KeyError, ValueError, TypeError) as e:
+                return self._send_json(400, {"error": f"无效的任务参数: {e}"})
+            return self._send_json(202, status)
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+            status = jobs.cancel(parts[1])
+            if status is None:
+                return self._send_json(404, {"error": "任务不存在"})
+            return self._send_json(202, status)
+        return self._send_json(404, {"error": "未知路径"})
+
+    def log_message(self, format, *args):
+        # 访问日志写到 stderr，避免混入任务日志
+        sys.stderr.write("%s - %s\n" % (self.address_string(), format % args))
 
-def main():
-    parser = argparse.ArgumentParser(description='根据参考表格筛选文件，复制到目标文件夹并重命名')
+def create_job_http_server(job_server, host='127.0.0.1', port=8765):
+    """创建绑定到 host:port 的 HTTP 服务（尚未开始 serve_forever）。"""
+    httpd = ThreadingHTTPServer((host, port), _JobRequestHandler)
+    httpd.job_server = job_server
+    return httpd
+
+def _check_paths(source, target, reference):
+    """校验源目录、目标父目录与参考表格是否存在，返回错误信息或 None。"""
+    if not os.path.exists(source):
+        return f"源文件夹不存在: {source}"
+
+    target_parent = os.path.dirname(target)
+    if target_parent and not os.path.exists(target_parent):
+        return f"目标文件夹的父目录不存在: {target_parent}"
+
+    if not os.path.exists(reference):
+        return f"参考表格文件不存在: {reference}"
+    return None
+
+def _validate_paths(args):
+    """命令行参数的路径校验，出错时打印提示并返回 False。"""
+    error = _check_paths(args.source, args.target, args.reference)
+    if error:
+        print(f"错误: {error}")
+        return False
+    return True
+
+def _add_job_arguments(parser):
     parser.add_argument('--source', '-s', required=True, help='源文件夹路径，包含需要筛选的照片文件')
     parser.add_argument('--target', '-t', required=True, help='目标文件夹路径，用于存放筛选后的文件')
     parser.add_argument('--reference', '-r', required=True, help='参考表格文件路径，包含标识符和对应的备注')
     parser.add_argument('--ai-naming', action='store_true', help='使用AI视觉理解进行重命名')
-    
-    args = parser.parse_args()
-    
-    # 验证路径
-    if not os.path.exists(args.source):
-        print(f"错误: 源文件夹不存在: {args.source}")
+
+def _plan_main(argv):
+    parser = argparse.ArgumentParser(prog='file_filter.py plan', description='扫描并匹配源文件，生成复制计划文件（不复制）')
+    _add_job_arguments(parser)
+    parser.add_argument('--plan', '-p', required=True, help='输出的计划文件路径（JSON Lines）')
+    args = parser.parse_args(argv)
+
+    if not _validate_paths(args):
+        return
+    entries = build_plan(args.source, args.target, args.reference, use_ai_naming=args.ai_naming)
+    if entries is None:
         return
+    write_plan(args.plan, args.source, args.target, entries)
+    print(f"已生成计划: {args.plan}，共 {len(entries)} 个文件")
 
-    target_parent = os.path.dirname(args.target)
-    if target_parent and not os.path.exists(target_parent):
-        print(f"错误: 目标文件夹的父目录不存在: {target_parent}")
+def _apply_main(argv):
+    parser = argparse.ArgumentParser(prog='file_filter.py apply', description='执行计划文件（可只执行其中一个分片）')
+    parser.add_argument('--plan', '-p', required=True, help='plan 命令生成的计划文件路径')
+    parser.add_argument('--shard', default='0/1', help='分片 i/N（i 从 0 开始），默认 0/1 即全部执行')
+    parser.add_argument('--target', '-t', help='覆盖计划中的目标文件夹（各节点挂载路径不同时使用）')
+    parser.add_argument('--source', '-s', help='覆盖计划中的源文件夹（各节点挂载路径不同时使用）')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.plan):
+        print(f"错误: 计划文件不存在: {args.plan}")
         return
+    try:
+        shard_index, shard_count = parse_shard(args.shard)
+        apply_plan(args.plan, shard_index, shard_count, target_folder=args.target, source_folder=args.source)
+    except ValueError as e:
+        print(f"错误: {e}")
+
+def _multi_main(argv):
+    parser = argparse.ArgumentParser(prog='file_filter.py multi', description='一次扫描源文件夹，按多个参考表格分别筛选复制到各自目标文件夹')
+    parser.add_argument('--source', '-s', required=True, help='源文件夹路径，包含需要筛选的照片文件')
+    parser.add_argument('--job', '-j', nargs=2, action='append', required=True, metavar=('REFERENCE', 'TARGET'),
+                        help='一组参考表格与目标文件夹，可重复指定')
+    parser.add_argument('--ai-naming', action='store_true', help='使用AI视觉理解进行重命名')
+    args = parser.parse_args(argv)
+
+    for reference_file, target_folder in args.job:
+        error = _check_paths(args.source, target_folder, reference_file)
+        if error:
+            print(f"错误: {error}")
+            return
+    process_files_multi(args.source, [tuple(job) for job in args.job], use_ai_naming=args.ai_naming)
+
+def _serve_main(argv):
+    parser = argparse.ArgumentParser(prog='file_filter.py serve', description='以长驻服务方式接收并执行处理任务（本机 HTTP 接口）')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址，默认仅本机 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='监听端口，默认 8765')
+    parser.add_argument('--workers', type=int, default=2, help='同时执行的任务数，默认 2')
+    args = parser.parse_args(argv)
 
-    if not os.path.exists(args.reference):
-        print(f"错误: 参考表格文件不存在: {args.reference}")
+    job_server = JobServer(max_workers=max(1, args.workers))
+    httpd = create_job_http_server(job_server, args.host, args.port)
+    print(f"任务服务已启动: http://{args.host}:{httpd.server_address[1]}（{args.workers} 个工作线程），按 Ctrl+C 停止")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        job_server.shutdown()
+        print("任务服务已停止")
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # 子命令：plan 只生成计划，apply 执行计划或其分片，serve 启动任务服务，multi 一次扫描分发到多个目标；其余参数沿用一次性处理模式
+    if argv and argv[0] == 'plan':
+        return _plan_main(argv[1:])
+    if argv and argv[0] == 'apply':
+        return _apply_main(argv[1:])
+    if argv and argv[0] == 'serve':
+        return _serve_main(argv[1:])
+    if argv and argv[0] == 'multi':
+        return _multi_main(argv[1:])
+
+    parser = argparse.ArgumentParser(description='根据参考表格筛选文件，复制到目标文件夹并重命名（另有 plan/apply/serve/multi 子命令）')
+    _add_job_arguments(parser)
+    parser.add_argument('--watch', action='store_true', help='持续监听源文件夹，新文件写入完成后立即处理')
+    parser.add_argument('--settle', type=float, default=2.0, help='监听模式下判定文件写入完成的静止时间（秒），默认 2')
+    parser.add_argument('--poll', action='store_true', help='监听模式下强制使用轮询（如网络文件系统）')
+    parser.add_argument('--archive', choices=['zip', 'tar'], help='将匹配文件直接写入归档，此时 --target 为归档文件路径')
+    
+    args = parser.parse_args(argv)
+    
+    # 验证路径
+    if not _validate_paths(args):
         return
     
     # 处理文件
-    process_files(args.source, args.target, args.reference, use_ai_naming=args.ai_naming)
+    if args.archive and args.watch:
+        print("错误: --archive 不能与 --watch 同时使用")
+        return
+    if args.archive:
+        process_files_to_archive(args.source, args.target, args.reference, archive_format=args.archive, use_ai_naming=args.ai_naming)
+    elif args.watch:
+        watch_folder(args.source, args.target, args.reference, use_ai_naming=args.ai_naming,
+                     settle_s=args.settle, force_polling=args.poll)
+    else:
+        process_files(args.source, args.target, args.reference, use_ai_naming=args.ai_naming)
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,26 @@
+import collections
+import hashlib
+import http.client
+import json
+import os
 import sys
+import tarfile
+import threading
+import time
+import urllib.request
+import zipfile
 from pathlib import Path
 
+import pytest
+
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
-from file_filter import process_files
+from file_filter import process_files, build_plan, write_plan, apply_plan, _compute_sha256, _copy_file, watch_folder
+from file_filter import JobServer, create_job_http_server
+from file_filter import IdentifierIndex, _match_tokens, _read_identifiers
+from file_filter import process_files_multi
+from file_filter import _OperationCancelled, _copy_with_verify, _copy_to_many_with_verify
+from file_filter import _AdaptiveRateController, analyze_image_with_qwen
+from file_filter import process_files_to_archive, _write_archive_entry
 
 
 def test_duplicate_file_names(tmp_path):
@@ -26,3 +44,725 @@ def test_duplicate_file_names(tmp_path):
     assert (target / "1234.jpg").exists()
     assert (target / "1234_1.jpg").exists()
 
+
+
+def test_plan_apply_shards(tmp_path):
+    """Sharded apply runs should produce the same deterministic names as the plan."""
+
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    target.mkdir()
+
+    (source / "img_1234.jpg").write_text("a")
+    (source / "holiday1234.jpg").write_text("b")
+    (source / "5678.jpg").write_text("c")
+    (source / "unrelated.txt").write_text("d")
+    # 目标目录中已有的文件在生成计划时就应被避开
+    (target / "5678.jpg").write_text("old")
+
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n5678\n")
+
+    entries = build_plan(str(source), str(target), str(reference))
+    plan = tmp_path / "plan.jsonl"
+    write_plan(str(plan), str(source), str(target), entries)
+
+    assert sorted(e["target"] for e in entries) == ["1234.jpg", "1234_1.jpg", "5678_1.jpg"]
+
+    done = apply_plan(str(plan), 0, 2) + apply_plan(str(plan), 1, 2)
+    assert done == 3
+    for entry in entries:
+        assert (target / entry["target"]).read_text() == (source / entry["source"]).read_text()
+    assert (target / "5678.jpg").read_text() == "old"
+
+    # 重跑已完成的分片不应产生新文件
+    assert apply_plan(str(plan), 0, 2) == len(entries[0::2])
+    assert len(list(target.iterdir())) == 4
+
+
+
+def test_build_plan_cancelled_returns_none(tmp_path):
+    """A cancelled scan yields no plan rather than a truncated one that looks complete."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    for i in range(3):
+        (source / f"img_123{i}.jpg").write_text("a")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1230\n1231\n1232\n")
+    checks = []
+
+    assert build_plan(str(source), str(tmp_path / "out"), str(reference),
+                      is_cancelled=lambda: checks.append(1) or len(checks) > 2) is None
+
+
+def test_apply_plan_skips_unreadable_existing_target(tmp_path, monkeypatch):
+    """An existing target that cannot be read skips only that entry instead of aborting the shard."""
+
+    import file_filter
+
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    target.mkdir()
+    (source / "img_1234.jpg").write_text("a")
+    (source / "img_5678.jpg").write_text("b")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n5678\n")
+    plan = tmp_path / "plan.jsonl"
+    write_plan(str(plan), str(source), str(target), build_plan(str(source), str(target), str(reference)))
+
+    (target / "1234.jpg").write_text("x")
+    original_hash = file_filter._compute_sha256
+
+    def _hash(path, *args, **kwargs):
+        if os.path.basename(path) == "1234.jpg":
+            raise PermissionError(13, "Permission denied", path)
+        return original_hash(path, *args, **kwargs)
+
+    monkeypatch.setattr(file_filter, "_compute_sha256", _hash)
+    assert apply_plan(str(plan)) == 1
+    assert (target / "5678.jpg").read_text() == "b"
+
+def test_apply_plan_with_relocated_source(tmp_path):
+    """Plans store source paths relative to the source root so a node can apply them from another mount point."""
+
+    source = tmp_path / "mnt_a" / "photos"
+    (source / "sub").mkdir(parents=True)
+    (source / "sub" / "img_1234.jpg").write_text("a")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n")
+    plan = tmp_path / "plan.jsonl"
+    write_plan(str(plan), str(source), str(tmp_path / "out"), build_plan(str(source), str(tmp_path / "out"), str(reference)))
+    assert json.loads(plan.read_text().splitlines()[1])["source"] == "sub/img_1234.jpg"
+
+    # 另一节点把同一存储挂载在别处
+    moved = tmp_path / "mnt_b" / "photos"
+    moved.parent.mkdir()
+    os.rename(source, moved)
+    target = tmp_path / "node_out"
+    assert apply_plan(str(plan), target_folder=str(target), source_folder=str(moved)) == 1
+    assert (target / "1234.jpg").read_text() == "a"
+
+
+@pytest.mark.parametrize("backend", ["copy_file_range", "sendfile", "shutil"])
+def test_copy_backends_and_hashing(tmp_path, backend):
+    """Every copy backend and both hashing paths should agree with hashlib."""
+
+    if backend != "shutil" and not hasattr(os, backend):
+        pytest.skip(f"os.{backend} not available")
+
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    source = tmp_path / "src.bin"
+    target = tmp_path / "dst.bin"
+    source.write_bytes(data)
+
+    _copy_file(str(source), str(target), backend=backend)
+
+    expected = hashlib.sha256(data).hexdigest()
+    assert target.read_bytes() == data
+    assert _compute_sha256(str(target)) == expected
+    assert _compute_sha256(str(target), chunk_size=4096, mmap_threshold=1) == expected
+
+
+
+def test_shutil_backend_keeps_copy2_when_cancellable(tmp_path, monkeypatch):
+    """The shutil backend keeps shutil.copy2's fast path even with a cancel flag, checking it around the copy."""
+
+    import file_filter
+
+    source = tmp_path / "src.bin"
+    source.write_bytes(b"data")
+    calls = []
+    original_copy2 = file_filter.shutil.copy2
+    monkeypatch.setattr(file_filter.shutil, "copy2", lambda src, dst: calls.append(src) or original_copy2(src, dst))
+
+    _copy_file(str(source), str(tmp_path / "dst1.bin"), backend="shutil", is_cancelled=lambda: False)
+    assert calls == [str(source)]
+    assert (tmp_path / "dst1.bin").read_bytes() == b"data"
+
+    # 复制过程中请求取消：文件复制完成后立即中止
+    with pytest.raises(_OperationCancelled):
+        _copy_file(str(source), str(tmp_path / "dst2.bin"), backend="shutil", is_cancelled=lambda: len(calls) > 1)
+    assert len(calls) == 2
+
+@pytest.mark.parametrize("force_polling", [False, True])
+def test_watch_folder_processes_new_files(tmp_path, force_polling):
+    """Files landing after the watcher starts are copied once they stop changing."""
+
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    (source / "old_1234.jpg").write_text("existing")
+
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n5678\n")
+
+    deadline = time.monotonic() + 10
+    copied = threading.Event()
+    stop = lambda: copied.is_set() or time.monotonic() > deadline
+    on_progress = lambda processed, total, matched, current: matched and copied.set()
+    watcher = threading.Thread(
+        target=watch_folder,
+        args=(str(source), str(target), str(reference)),
+        kwargs={"settle_s": 0.3, "poll_interval_s": 0.1, "is_cancelled": stop, "progress_callback": on_progress,
+                "force_polling": force_polling},
+    )
+    watcher.start()
+    time.sleep(0.3)
+
+    (source / "sub").mkdir()
+    with open(source / "sub" / "img5678.jpg", "w") as f:
+        f.write("part")
+        f.flush()
+        time.sleep(0.1)
+        f.write("ial")
+    watcher.join()
+
+    assert (target / "5678.jpg").read_text() == "partial"
+    assert not (target / "1234.jpg").exists()
+
+
+def test_job_server_runs_submitted_jobs(tmp_path):
+    """Jobs submitted over HTTP run on the pool and report status, progress and log."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "img_1234.jpg").write_text("a")
+    (source / "other.jpg").write_text("b")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n")
+
+    job_server = JobServer(max_workers=2)
+    httpd = create_job_http_server(job_server, port=0)
+    serving = threading.Thread(target=httpd.serve_forever, daemon=True)
+    serving.start()
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+    try:
+        job_ids = []
+        for name in ("out1", "out2"):
+            body = json.dumps({"source": str(source), "target": str(tmp_path / name), "reference": str(reference)})
+            request = urllib.request.Request(f"{base}/jobs", data=body.encode(), method="POST")
+            with urllib.request.urlopen(request) as response:
+                assert response.status == 202
+                job_ids.append(json.load(response)["id"])
+
+        for job_id in job_ids:
+            assert job_server.wait(job_id, timeout=10)["state"] == "done"
+            with urllib.request.urlopen(f"{base}/jobs/{job_id}") as response:
+                status = json.load(response)
+            assert status["matched"] == 1
+            assert status["progress"]["processed"] == 2
+            assert any("1234.jpg" in line for line in status["log"])
+        assert (tmp_path / "out1" / "1234.jpg").exists()
+        assert (tmp_path / "out2" / "1234.jpg").exists()
+
+        with pytest.raises(ValueError):
+            job_server.submit(str(tmp_path / "missing"), str(tmp_path / "out3"), str(reference))
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        job_server.shutdown()
+
+
+
+
+def test_job_server_concurrent_jobs_share_target(tmp_path, monkeypatch):
+    """Two pool jobs writing the same name into one target folder must not overwrite each other."""
+
+    import file_filter
+
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n")
+    sources = []
+    for content in ("a", "b"):
+        source = tmp_path / f"source_{content}"
+        source.mkdir()
+        (source / "img_1234.jpg").write_text(content)
+        sources.append(source)
+    target = tmp_path / "out"
+    target.mkdir()
+
+    # 两个任务都选好目标名称后才开始复制，放大竞态窗口
+    barrier = threading.Barrier(2, timeout=5)
+    original_copy = file_filter._copy_with_verify
+
+    def _copy_after_both_named(*args, **kwargs):
+        barrier.wait()
+        return original_copy(*args, **kwargs)
+
+    monkeypatch.setattr(file_filter, "_copy_with_verify", _copy_after_both_named)
+    job_server = JobServer(max_workers=2)
+    try:
+        job_ids = [job_server.submit(str(source), str(target), str(reference))["id"] for source in sources]
+        for job_id in job_ids:
+            status = job_server.wait(job_id, timeout=10)
+            assert status["state"] == "done" and status["matched"] == 1
+    finally:
+        job_server.shutdown()
+
+    assert sorted(os.listdir(target)) == ["1234.jpg", "1234_1.jpg"]
+    assert {p.read_text() for p in target.iterdir()} == {"a", "b"}
+
+@pytest.mark.parametrize("length", ["-1", str(2 * 1024 * 1024)])
+def test_job_server_rejects_bad_content_length(length):
+    """A negative or oversized Content-Length gets a 400 without blocking on the body."""
+
+    job_server = JobServer(max_workers=1)
+    httpd = create_job_http_server(job_server, port=0)
+    serving = threading.Thread(target=httpd.serve_forever, daemon=True)
+    serving.start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", httpd.server_address[1], timeout=5)
+        conn.putrequest("POST", "/jobs")
+        conn.putheader("Content-Length", length)
+        conn.endheaders()
+        response = conn.getresponse()
+        assert response.status == 400
+        assert "error" in json.load(response)
+        conn.close()
+        assert job_server.list() == []
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        job_server.shutdown()
+
+def test_identifier_index_matches_in_memory_lookup(tmp_path):
+    """The on-disk index should give the same exact and fuzzy matches as the list."""
+
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id,note\n" + "".join(f"sku{i:05d},x\n" for i in range(2000)) + "abcdef,y\n")
+
+    index = IdentifierIndex.for_reference(str(reference))
+    identifiers = _read_identifiers(str(reference))
+    assert len(index) == len(identifiers) == 2001
+    assert "sku00042" in index and "sku99999" not in index
+
+    for tokens in (["sku00042"], ["abcdex"], ["zzzzzz"], ["img", "abcdeg"]):
+        assert _match_tokens(tokens, index, "f.jpg") == _match_tokens(tokens, identifiers, "f.jpg")
+
+    # 未变化时复用已有索引，表格更新后自动重建
+    mtime = os.path.getmtime(index.index_file)
+    assert IdentifierIndex.for_reference(str(reference)).index_file == index.index_file
+    assert os.path.getmtime(index.index_file) == mtime
+    reference.write_text("id\nnewsku\n")
+    assert "newsku" in IdentifierIndex.for_reference(str(reference))
+
+
+
+def test_identifier_index_compact_schema_and_format_rebuild(tmp_path, monkeypatch):
+    """Postings live in one clustered WITHOUT ROWID table keyed by interned gram ids; older formats are rebuilt."""
+
+    import sqlite3
+
+    import file_filter
+
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n" + "".join(f"sku{i:05d}\n" for i in range(100)))
+    index = IdentifierIndex.for_reference(str(reference))
+    conn = sqlite3.connect(index.index_file)
+    try:
+        schema = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE tbl_name = 'grams'").fetchall())
+        postings = conn.execute("SELECT COUNT(*) FROM grams").fetchone()[0]
+    finally:
+        conn.close()
+    assert list(schema) == ["grams"] and "WITHOUT ROWID" in schema["grams"]
+    assert postings == sum(len(file_filter._identifier_grams(f"sku{i:05d}")) for i in range(100))
+    index.close()
+
+    # 索引格式升级后，即使表格未变也会重建
+    mtime = os.path.getmtime(index.index_file)
+    time.sleep(0.01)
+    monkeypatch.setattr(file_filter, "IDENTIFIER_INDEX_FORMAT", file_filter.IDENTIFIER_INDEX_FORMAT + 1)
+    rebuilt = IdentifierIndex.for_reference(str(reference))
+    assert os.path.getmtime(rebuilt.index_file) != mtime
+    assert "sku00042" in rebuilt
+
+def test_process_files_multi_fans_out(tmp_path, monkeypatch):
+    """One scan should feed every (reference, target) pair, reading each source once."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "img_1234.jpg").write_text("shared")
+    (source / "img_5678.jpg").write_text("only-b")
+    (source / "misc.jpg").write_text("none")
+
+    ref_a = tmp_path / "a.csv"
+    ref_a.write_text("id\n1234\n")
+    ref_b = tmp_path / "b.csv"
+    ref_b.write_text("id\n1234\n5678\n")
+    out_a, out_b = tmp_path / "out_a", tmp_path / "out_b"
+
+    import file_filter
+    walks = []
+    original_iter = file_filter._iter_source_files
+    monkeypatch.setattr(file_filter, "_iter_source_files", lambda folder: walks.append(folder) or original_iter(folder))
+
+    counts = process_files_multi(str(source), [(str(ref_a), str(out_a)), (str(ref_b), str(out_b)), (str(ref_b), str(out_a))])
+
+    assert counts == [1, 2, 2]
+    assert len(walks) == 1
+    assert sorted(p.name for p in out_a.iterdir()) == ["1234.jpg", "1234_1.jpg", "5678.jpg"]
+    assert sorted(p.name for p in out_b.iterdir()) == ["1234.jpg", "5678.jpg"]
+    assert (out_b / "1234.jpg").read_text() == "shared"
+
+
+def test_cancel_inside_copy_removes_partial_target(tmp_path):
+    """Cancelling between chunks of a copy/verify aborts it and leaves no target."""
+
+    source = tmp_path / "src.bin"
+    target = tmp_path / "dst.bin"
+    source.write_bytes(os.urandom(5 * 1024 * 1024))
+
+    checks = []
+    is_cancelled = lambda: checks.append(1) or len(checks) >= 8
+
+    with pytest.raises(_OperationCancelled):
+        _copy_with_verify(str(source), str(target), is_cancelled=is_cancelled)
+    assert not target.exists()
+
+
+def test_cancel_aborts_in_flight_ai_request(tmp_path, monkeypatch):
+    """A hanging AI request is abandoned as soon as the cancel flag is raised."""
+
+    from PIL import Image
+
+    import file_filter
+
+    class _SlowSession:
+        def post(self, *args, **kwargs):
+            time.sleep(3)
+            raise AssertionError("request should have been abandoned")
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(file_filter, "_get_ai_session", lambda: _SlowSession())
+    monkeypatch.setattr(file_filter, "AI_REQUEST_QPS", 0)
+
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    Image.new("RGB", (64, 48), "red").save(source / "photo.jpg")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\nphoto\n")
+
+    cancel_at = time.monotonic() + 0.3
+    started = time.monotonic()
+    process_files(str(source), str(target), str(reference), is_cancelled=lambda: time.monotonic() > cancel_at, use_ai_naming=True)
+
+    assert time.monotonic() - started < 2
+    assert sorted(p.name for p in source.iterdir()) == ["photo.jpg"]
+    assert list(target.iterdir()) == []
+
+
+def test_adaptive_rate_controller_aimd():
+    """Healthy requests raise rate and concurrency additively only while they bind; congestion halves them."""
+
+    controller = _AdaptiveRateController(initial_qps=50.0, min_qps=0.1, max_qps=100.0, max_concurrency=4)
+    for _ in range(21):
+        limited = controller.acquire()
+        controller.release(200, 0.01, limited=limited)
+    # 第一次请求无需等待，其后 20 次都等了速率间隔；顺序调用从未受并发上限约束
+    assert controller.rate == pytest.approx(51.0)
+    assert int(controller.limit) == 1
+
+    # 第二个请求需要等待并发名额时才提高并发上限
+    held = controller.acquire()
+    waiting = []
+    thread = threading.Thread(target=lambda: waiting.append(controller.acquire()))
+    thread.start()
+    time.sleep(0.1)
+    controller.release(200, 0.01, limited=held)
+    thread.join(timeout=5)
+    assert waiting[0][1]
+    controller.release(200, 0.01, limited=waiting[0])
+    assert int(controller.limit) == 2
+
+    rate = controller.rate
+    controller.acquire()
+    controller.release(429, 0.01, retry_after_s=0.3)
+    assert controller.rate == pytest.approx(rate / 2)
+    assert int(controller.limit) == 1
+
+    # Retry-After 期间所有请求都要等待
+    started = time.monotonic()
+    controller.acquire()
+    assert time.monotonic() - started >= 0.25
+    controller.release(200, 0.01)
+
+
+def test_adaptive_rate_controller_ignores_unused_headroom(capsys):
+    """Slow sequential requests never wait on the limiter, so the allowed rate stays put and the real rate is reported."""
+
+    controller = _AdaptiveRateController(initial_qps=50.0, min_qps=0.1, max_qps=100.0, max_concurrency=4)
+    for _ in range(5):
+        limited = controller.acquire()
+        time.sleep(0.05)  # 延迟大于 1/50 秒的请求间隔
+        controller.release(200, 0.05, limited=limited)
+
+    assert controller.rate == pytest.approx(50.0)
+    assert int(controller.limit) == 1
+    assert controller.measured_qps() < 25
+    controller.report()
+    assert "允许速率 50.00 QPS" in capsys.readouterr().out
+
+
+def test_ai_request_honors_retry_after(tmp_path, monkeypatch):
+    """429 responses are retried after at least the server's Retry-After."""
+
+    from PIL import Image
+
+    import file_filter
+
+    class _Response:
+        def __init__(self, status, headers=None, body=None):
+            self.status_code = status
+            self.headers = headers or {}
+            self._body = body
+
+        def json(self):
+            return self._body
+
+        def raise_for_status(self):
+            if self.status_code >= 400:
+                raise file_filter.requests.HTTPError(str(self.status_code))
+
+    responses = [
+        _Response(429, {"Retry-After": "0.5"}),
+        _Response(200, body={"output": {"text": "红色 方块.jpg"}}),
+    ]
+
+    class _Session:
+        def post(self, *args, **kwargs):
+            return responses.pop(0)
+
+    sleeps = []
+    monkeypatch.setattr(file_filter, "_get_ai_session", lambda: _Session())
+    monkeypatch.setattr(file_filter, "_sleep_cancellable", lambda seconds, is_cancelled=None: sleeps.append(seconds))
+    monkeypatch.setattr(file_filter, "_AI_CONTROLLER", None)
+    monkeypatch.setattr(file_filter, "AI_REQUEST_QPS", 100.0)
+    monkeypatch.setattr(file_filter, "AI_MAX_QPS", 100.0)
+
+    image = tmp_path / "photo.png"
+    Image.new("RGB", (64, 48), "red").save(image)
+
+    assert analyze_image_with_qwen(str(image)) == "红色_方块"
+    assert len(sleeps) == 1 and sleeps[0] >= 0.5
+    assert file_filter._AI_CONTROLLER.congested == 1
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar"])
+def test_process_files_to_archive(tmp_path, archive_format):
+    """Matched files stream into one archive with process_files names and a SHA256SUMS manifest."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "img_1234.jpg").write_bytes(b"a" * 1000)
+    (source / "holiday1234.jpg").write_bytes(b"b" * 10)
+    (source / "notes_5678.txt").write_text("c" * 500)
+    (source / "other.jpg").write_bytes(b"d")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n5678\n")
+    archive_file = tmp_path / f"out.{archive_format}"
+
+    assert process_files_to_archive(str(source), str(archive_file), str(reference)) == 3
+    assert not (tmp_path / f"out.{archive_format}.part").exists()
+
+    if archive_format == "zip":
+        with zipfile.ZipFile(archive_file) as zf:
+            contents = {info.filename: zf.read(info) for info in zf.infolist()}
+            assert zf.getinfo("1234.jpg").compress_type == zipfile.ZIP_STORED
+            assert zf.getinfo("5678.txt").compress_type == zipfile.ZIP_DEFLATED
+    else:
+        with tarfile.open(archive_file) as tf:
+            contents = {m.name: tf.extractfile(m).read() for m in tf.getmembers()}
+
+    assert sorted(contents) == ["1234.jpg", "1234_1.jpg", "5678.txt", "SHA256SUMS"]
+    manifest = dict(line.split("  ")[::-1] for line in contents.pop("SHA256SUMS").decode().splitlines())
+    assert manifest == {name: hashlib.sha256(data).hexdigest() for name, data in contents.items()}
+
+
+
+
+def test_process_files_to_archive_clamps_pre_1980_timestamps(tmp_path):
+    """A matched file dated before 1980 is stored with a clamped date instead of aborting the zip."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    old_file = source / "img_1234.jpg"
+    old_file.write_bytes(b"old")
+    os.utime(old_file, (0, 0))
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n")
+    archive_file = tmp_path / "out.zip"
+
+    assert process_files_to_archive(str(source), str(archive_file), str(reference)) == 1
+    with zipfile.ZipFile(archive_file) as zf:
+        assert zf.read("1234.jpg") == b"old"
+        assert zf.getinfo("1234.jpg").date_time[0] == 1980
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar"])
+def test_process_files_to_archive_skips_unreadable_source(tmp_path, archive_format):
+    """A matched file that cannot be opened is skipped; the rest of the archive is still delivered."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "img_1234.jpg").write_bytes(b"ok")
+    # 扫描后消失的文件：悬空符号链接会出现在文件列表中，但无法打开
+    os.symlink(tmp_path / "missing.jpg", source / "img_5678.jpg")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n5678\n")
+    archive_file = tmp_path / f"out.{archive_format}"
+
+    assert process_files_to_archive(str(source), str(archive_file), str(reference)) == 1
+    if archive_format == "zip":
+        with zipfile.ZipFile(archive_file) as zf:
+            names = zf.namelist()
+    else:
+        with tarfile.open(archive_file) as tf:
+            names = tf.getnames()
+    assert sorted(names) == ["1234.jpg", "SHA256SUMS"]
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar"])
+def test_archive_entry_rejects_file_growing_while_written(tmp_path, archive_format):
+    """A source file that grows after it was opened must fail instead of being silently truncated."""
+
+    source_file = tmp_path / "img_1234.jpg"
+    source_file.write_bytes(b"a" * 1000)
+    grown = []
+
+    def _grow_once():
+        if not grown:
+            grown.append(True)
+            with open(source_file, "ab") as f:
+                f.write(b"b" * 100)
+        return False
+
+    archive_file = tmp_path / f"out.{archive_format}"
+    opener = (lambda: tarfile.open(archive_file, "w")) if archive_format == "tar" else (
+        lambda: zipfile.ZipFile(archive_file, "w"))
+    with opener() as archive, open(source_file, "rb") as fsrc:
+        with pytest.raises(IOError):
+            _write_archive_entry(archive, archive_format, fsrc, "1234.jpg", is_cancelled=_grow_once)
+    assert grown
+
+def test_process_files_multi_aliased_targets(tmp_path, monkeypatch):
+    """Jobs naming the same folder with different spellings must not share a target file."""
+
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "img_1234.jpg").write_text("shared")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n")
+    out = tmp_path / "out"
+    out.mkdir()
+
+    monkeypatch.chdir(tmp_path)
+    counts = process_files_multi(str(source), [(str(reference), "out"), (str(reference), str(out) + os.sep)])
+
+    assert counts == [1, 1]
+    assert sorted(p.name for p in out.iterdir()) == ["1234.jpg", "1234_1.jpg"]
+
+
+def test_cancel_during_multi_target_verify_removes_all_targets(tmp_path):
+    """Cancelling while verifying later targets also drops the already-verified ones."""
+
+    source = tmp_path / "src.bin"
+    source.write_bytes(os.urandom(3 * 1024 * 1024))
+    targets = [tmp_path / "a.bin", tmp_path / "b.bin"]
+
+    checks = []
+    # 读写阶段 4 次检查，第一个目标校验 4 次，之后在第二个目标校验时取消
+    is_cancelled = lambda: checks.append(1) or len(checks) >= 10
+
+    with pytest.raises(_OperationCancelled):
+        _copy_to_many_with_verify(str(source), [str(t) for t in targets], is_cancelled=is_cancelled)
+    assert not any(t.exists() for t in targets)
+
+
+def test_identifier_index_falls_back_when_reference_dir_read_only(tmp_path, monkeypatch):
+    """An unwritable reference directory puts the index in the temp cache instead of failing."""
+
+    import file_filter
+
+    share = tmp_path / "share"
+    share.mkdir()
+    reference = share / "ref.csv"
+    reference.write_text("id\nabc123\n")
+    cache_root = tmp_path / "cache"
+    cache_root.mkdir()
+
+    real_access = os.access
+    monkeypatch.setattr(file_filter.os, "access", lambda path, mode: False if os.path.samefile(path, share) else real_access(path, mode))
+    monkeypatch.setattr(file_filter.tempfile, "tempdir", str(cache_root))
+
+    index = IdentifierIndex.for_reference(str(reference))
+    assert "abc123" in index
+    assert os.path.dirname(index.index_file) == str(cache_root / "photo_filter_index")
+    assert os.listdir(share) == ["ref.csv"]
+
+    # 第二次直接复用缓存中的索引
+    assert IdentifierIndex.for_reference(str(reference)).index_file == index.index_file
+
+    # 没有任何可写位置时，_load_identifiers 退回到内存列表
+    monkeypatch.setattr(file_filter.os, "access", lambda path, mode: False)
+    monkeypatch.setattr(file_filter, "IDENTIFIER_INDEX_DIR", str(tmp_path / "other"))
+    monkeypatch.setattr(file_filter, "IDENTIFIER_INDEX_THRESHOLD_BYTES", 0)
+    monkeypatch.setattr(file_filter, "_IDENTIFIER_CACHE", collections.OrderedDict())
+    assert file_filter._load_identifiers(str(reference)) == ["abc123"]
+
+
+
+def test_identifier_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    """The parsed-reference cache keeps at most IDENTIFIER_CACHE_MAX_ENTRIES tables, dropping the oldest."""
+
+    import file_filter
+
+    monkeypatch.setattr(file_filter, "_IDENTIFIER_CACHE", collections.OrderedDict())
+    monkeypatch.setattr(file_filter, "IDENTIFIER_CACHE_MAX_ENTRIES", 2)
+    refs = []
+    for i in range(3):
+        ref = tmp_path / f"ref{i}.csv"
+        ref.write_text(f"id\n{i}000\n")
+        refs.append(str(ref))
+
+    file_filter._load_identifiers(refs[0])
+    file_filter._load_identifiers(refs[1])
+    file_filter._load_identifiers(refs[0])  # 命中缓存，ref0 变为最近使用
+    file_filter._load_identifiers(refs[2])
+
+    assert list(file_filter._IDENTIFIER_CACHE) == [os.path.abspath(refs[0]), os.path.abspath(refs[2])]
+
+def test_watch_folder_overflow_rescan_skips_startup_files(tmp_path, monkeypatch):
+    """A full rescan after an event-queue overflow must not copy files present at startup."""
+
+    import file_filter
+
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    source.mkdir()
+    (source / "old_1234.jpg").write_text("existing")
+    reference = tmp_path / "ref.csv"
+    reference.write_text("id\n1234\n5678\n")
+
+    calls = []
+
+    def _overflow_once(self, timeout):
+        time.sleep(0.05)
+        calls.append(1)
+        if len(calls) == 1:
+            (source / "img5678.jpg").write_text("new")
+            return None
+        return []
+
+    monkeypatch.setattr(file_filter._PollingWatcher, "changes", _overflow_once)
+    # 运行足够多轮，保证溢出后入队的文件都已过静止期并处理完
+    watch_folder(
+        str(source), str(target), str(reference), settle_s=0.1, poll_interval_s=0.05, force_polling=True,
+        is_cancelled=lambda: len(calls) > 20,
+    )
+
+    assert sorted(p.name for p in target.iterdir()) == ["5678.jpg"]